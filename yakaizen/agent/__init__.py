@@ -1,11 +1,28 @@
 import sys
+import time
+import asyncio
+import datetime
+import hashlib
+import threading
+import functools
+import collections
+import concurrent.futures
 import yakaizen.ether_sqlite as ethsqlite
 import yakaizen.ether_proxy as ethproxy
+import yakaizen.ether_async as ethasync
+import yakaizen.ether_shm as ethshm
+import yakaizen.ether_sharded as ethsharded
 from yakaizen.core import CHANNEL_PROD, CHANNEL_DEBUG, Channel
-from yakaizen.core import Agent, WorkflowAgent
+from yakaizen.core import Agent, WorkflowAgent, BroadcastRouter, WorkQueueRouter, AsyncMessage, MessageHeader
+from yakaizen import metrics, wire
 
 ETHERS = {'sqlite': ethsqlite.SQLiteEther,
-          'proxy': ethproxy.ProxyEther}
+          'proxy': ethproxy.ProxyEther,
+          'shm': ethshm.SharedMemoryEther,
+          'sharded': ethsharded.ShardedSQLiteEther}
+
+ASYNC_ETHERS = {'sqlite': ethasync.AsyncSQLiteEther,
+                'proxy': ethasync.AsyncProxyEther}
 
 class AgentHelper:
     def __init__(self):
@@ -17,9 +34,12 @@ class AgentHelper:
         args.add_argument("--kz-ether-args", help="Kaizen ether arguments")
         args.add_argument("--kz-cin", help="Kaizen input channel")
         args.add_argument("--kz-cout", help="Kaizen output channel, should not used except in special circumstances")
+        args.add_argument("--kz-group-commit", action="store_true", help="Commit concurrent sends together, sqlite ether only")
+        args.add_argument("--kz-metrics", metavar="DIR", help="Write metrics to DIR, see kz stats")
+        args.add_argument("--kz-metrics-port", type=int, metavar="PORT", help="Serve metrics on http://127.0.0.1:PORT/")
 
     @staticmethod
-    def get_ether(agent, args):
+    def get_ether(agent, args, asynchronous = False):
         if args.kz_ether is None:
             print(f"{agent}:ERROR: No ether specified.", file=sys.stderr)
             return None
@@ -28,18 +48,47 @@ class AgentHelper:
             print(f"{agent}:ERROR: ether {args.kz_ether} is not recognized.", file=sys.stderr)
             return None
 
+        if args.kz_metrics or args.kz_metrics_port:
+            metrics.enable(args.kz_metrics, args.kz_metrics_port, name=agent)
+
         if args.kz_ether == 'sqlite':
             if args.kz_ether_args is None:
                 print(f"{agent}:ERROR: ether sqlite requires a database file as argument.", file=sys.stderr)
                 return None
 
-            return ethsqlite.SQLiteEther(args.kz_ether_args)
+            if asynchronous:
+                return ethasync.AsyncSQLiteEther(args.kz_ether_args, group_commit=args.kz_group_commit)
+
+            return ethsqlite.SQLiteEther(args.kz_ether_args, group_commit=args.kz_group_commit)
         elif args.kz_ether == 'proxy':
             if args.kz_ether_args is None:
                 print(f"{agent}:ERROR: ether proxy requires a dialing address as argument.", file=sys.stderr)
                 return None
 
+            if asynchronous:
+                return ethasync.AsyncProxyEther(args.kz_ether_args)
+
             return ethproxy.ProxyEther(args.kz_ether_args)
+        elif args.kz_ether == 'shm':
+            if args.kz_ether_args is None:
+                print(f"{agent}:ERROR: ether shm requires a database file as argument.", file=sys.stderr)
+                return None
+
+            if asynchronous:
+                print(f"{agent}:ERROR: ether shm has no asynchronous interface.", file=sys.stderr)
+                return None
+
+            return ethshm.SharedMemoryEther(args.kz_ether_args)
+        elif args.kz_ether == 'sharded':
+            if args.kz_ether_args is None:
+                print(f"{agent}:ERROR: ether sharded requires a database file as argument.", file=sys.stderr)
+                return None
+
+            if asynchronous:
+                print(f"{agent}:ERROR: ether sharded has no asynchronous interface.", file=sys.stderr)
+                return None
+
+            return ethsharded.ShardedSQLiteEther(args.kz_ether_args, group_commit=args.kz_group_commit)
         else:
             raise NotImplementedError
 
@@ -55,11 +104,121 @@ class AgentHelper:
         print(f"SUCCESS: Agent {agent} started, listening to in={channels[0]}, out={channels[0]}", file=sys.stderr)
 
 
+class AgentStats:
+    """Records the metrics of an agent, see yakaizen.metrics"""
+
+    # traces remembered to count the traces an agent sees, and the
+    # messages it sees from each
+    recent_traces = 10000
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.in_flight = 0
+        self._traces = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def received(self, msg):
+        if not metrics.enabled:
+            return
+
+        with self._lock:
+            self.in_flight += 1
+            metrics.set_gauge('kz_agent_in_flight', self.in_flight, agent=self.agent)
+            metrics.inc('kz_agent_messages_total', agent=self.agent)
+
+            trace_id = msg.trace.trace_id
+            if trace_id in self._traces:
+                self._traces[trace_id][0] += 1
+                self._traces.move_to_end(trace_id)
+            else:
+                self._traces[trace_id] = [1, msg.trace.expiry]
+                metrics.inc('kz_agent_traces_total', agent=self.agent)
+
+            # the least recently seen trace is counted once it expires or
+            # is forgotten
+            now = datetime.datetime.utcnow()
+            while True:
+                oldest = next(iter(self._traces))
+                count, expiry = self._traces[oldest]
+                if oldest == trace_id or (len(self._traces) <= self.recent_traces and expiry > now):
+                    break
+
+                del self._traces[oldest]
+                metrics.observe('kz_agent_trace_messages', count, agent=self.agent)
+
+    def handled(self, seconds):
+        """Record a message as done, seconds is None if it failed"""
+
+        if not metrics.enabled:
+            return
+
+        with self._lock:
+            self.in_flight -= 1
+            metrics.set_gauge('kz_agent_in_flight', self.in_flight, agent=self.agent)
+
+        if seconds is not None:
+            metrics.observe('kz_handle_seconds', seconds, agent=self.agent)
+
+def _timed(handle, msg):
+    start = time.perf_counter()
+    out = handle(msg)
+    return (out, time.perf_counter() - start)
+
+# set in worker processes of a SimpleAgent with a process pool
+_worker_agent = None
+
+def _init_worker(agent):
+    global _worker_agent
+    _worker_agent = agent
+
+def _handle_in_worker(msg):
+    return _timed(_worker_agent.handle_message, msg)
+
+def _replayed(out, seconds):
+    return (out, seconds)
+
 class SimpleAgent(Agent):
+    # defaults for --kz-workers, --kz-pool, --kz-ordered, --kz-max-in-flight,
+    # --kz-work-queue and --kz-lease
+    workers = 1
+    pool = 'thread'
+    ordered = False
+    max_in_flight = None
+    work_queue = False
+    lease = 60
+
+    # deliveries of a work queue message before it is dropped
+    max_attempts = 3
+
+    # default for --kz-memoize. Memoized replies are dropped when older
+    # than memo_max_age seconds, and the least recently used when they
+    # take up more than memo_max_bytes. Change version when
+    # handle_message changes, so that older replies are not reused.
+    memoize = False
+    version = None
+    memo_max_bytes = 256 * 2**20
+    memo_max_age = 7 * 24 * 3600
+    memo_evict_every = 100
+
     def inject_args(self, parser):
         AgentHelper.inject_kz_args(parser)
+        parser.add_argument("--kz-workers", type=int, default=self.workers, help="Number of messages to handle concurrently")
+        parser.add_argument("--kz-pool", choices=['thread', 'process'], default=self.pool, help="Run handle_message in threads or processes")
+        parser.add_argument("--kz-ordered", action="store_true", default=self.ordered, help="Handle messages of a trace one at a time, in order")
+        parser.add_argument("--kz-max-in-flight", type=int, default=self.max_in_flight, help="Stop receiving while this many messages are being handled, default is twice the number of workers")
+        parser.add_argument("--kz-work-queue", action="store_true", default=self.work_queue, help="Share messages with the other copies of this agent, each message is handled by one of them")
+        parser.add_argument("--kz-lease", type=float, default=self.lease, help="Seconds a copy has to handle a message with --kz-work-queue before it is redelivered")
+        parser.add_argument("--kz-memoize", action="store_true", default=self.memoize, help="Reuse the replies to earlier messages with the same type, contents and attachments")
 
     def setup(self, args):
+        self.workers = args.kz_workers
+        self.pool = args.kz_pool
+        self.ordered = args.kz_ordered
+        self.max_in_flight = args.kz_max_in_flight or 2 * self.workers
+        self.work_queue = args.kz_work_queue
+        self.lease = args.kz_lease
+        self.memoize = args.kz_memoize
+
         ether = AgentHelper.get_ether(self.name, args)
         if ether is None:
             print(f"{self.name} ether setup failed.")
@@ -79,14 +238,182 @@ class SimpleAgent(Agent):
         raise NotImplementedError
 
     def handle_message(self, message):
+        """Return None, a message, or a list of messages to send in reply"""
         raise NotImplementedError
 
-    def run(self):
+    def get_router(self):
         ra = self.get_recv_args()
-        for msg in self.ether.recv(*ra):
-            out = self.handle_message(msg)
-            if out is not None:
-                self.ether.send(out)
+        if self.work_queue:
+            return WorkQueueRouter(self.ether, self.name, *ra, lease=self.lease, max_attempts=self.max_attempts)
+
+        return BroadcastRouter(self.ether, *ra)
+
+    def memo_key(self, msg):
+        """Return the key under which the replies to msg are memoized, or
+           None to always handle msg"""
+
+        atts = sorted((a.type_, a.hash) for a in msg.attachments)
+        return hashlib.sha256(wire.encode_value([self.name, self.version, msg.type_, msg.contents, atts])).hexdigest()
+
+    def _memo_lookup(self, msg):
+        """Return (key, replies), replies is None if there are none.
+
+           The sources of the stored replies were in another trace, so
+           the replies are re-parented to msg, their only source.
+        """
+
+        key = self.memo_key(msg)
+        value = self.ether.memo_get(key, self.memo_max_age) if key is not None else None
+        if value is None:
+            metrics.inc('kz_memo_misses_total', agent=self.name)
+            return (key, None)
+
+        metrics.inc('kz_memo_hits_total', agent=self.name)
+        return (key, [AsyncMessage(Channel(channel), type_, self, contents, [msg], msg.trace)
+                      for channel, type_, contents in wire.decode_value(value)])
+
+    def _memo_store(self, key, msg, out):
+        if key is None:
+            return
+
+        replies = out if isinstance(out, list) else ([] if out is None else [out])
+        for r in replies:
+            # blobs are not kept for memoized replies, and replies that
+            # start other traces cannot be moved to a new one
+            if len(r.attachments) or r.trace is None or r.trace.trace_id != msg.trace.trace_id:
+                return
+
+        value = wire.encode_value([(getattr(r.channel, 'name', r.channel), r.type_, r.contents) for r in replies])
+        self.ether.memo_put(key, self.name, value)
+
+        # stores complete on the executor's threads
+        with self._memo_lock:
+            self._memo_puts += 1
+            evict = self._memo_puts % self.memo_evict_every == 0
+
+        if evict:
+            self.ether.memo_evict(self.name, self.memo_max_bytes, self.memo_max_age)
+
+    def send_reply(self, out):
+        if out is None or out == []:
+            return
+
+        if isinstance(out, list):
+            self.ether.send_many(out)
+        else:
+            self.ether.send(out)
+
+    def __getstate__(self):
+        # agents are sent to worker processes, which do not use the ether
+        state = self.__dict__.copy()
+        state.pop('ether', None)
+        state.pop('router', None)
+        state.pop('stats', None)
+        state.pop('_memo_lock', None)
+        return state
+
+    def _make_executors(self):
+        if self.pool == 'process':
+            make = lambda n: concurrent.futures.ProcessPoolExecutor(n, initializer=_init_worker, initargs=(self,))
+        else:
+            make = lambda n: concurrent.futures.ThreadPoolExecutor(n)
+
+        if self.ordered:
+            # all messages of a trace go to the same single worker
+            return [make(1) for i in range(self.workers)]
+
+        return [make(self.workers)]
+
+    def run_concurrent(self):
+        executors = self._make_executors()
+        if self.pool == 'process':
+            handle = _handle_in_worker
+        else:
+            handle = functools.partial(_timed, self.handle_message)
+        in_flight = threading.BoundedSemaphore(self.max_in_flight or 2 * self.workers)
+
+        def done(msg, key, fut):
+            # runs in the executor's threads, so replies of a trace are
+            # sent in order when self.ordered
+            seconds = None
+            try:
+                out, seconds = fut.result()
+                self.send_reply(out)
+                self._memo_store(key, msg, out)
+                self.router.ack(msg)
+            except Exception as e:
+                print(f"{self.name}: handling message failed: {e!r}", file=sys.stderr)
+                self.router.release(msg)
+            finally:
+                self.stats.handled(seconds)
+                in_flight.release()
+
+        self.router = self.get_router()
+        self.stats = AgentStats(self.name)
+        self._memo_puts = 0
+        self._memo_lock = threading.Lock()
+        try:
+            for msg in self.router.recv():
+                in_flight.acquire()
+                self.stats.received(msg)
+                ex = executors[msg.trace.trace_id % len(executors)]
+                try:
+                    if self.pool == 'process' and isinstance(msg, MessageHeader):
+                        # workers have no ether to load contents from
+                        self.ether.fetch_contents([msg])
+                        self.ether.fetch_attachments([msg])
+
+                    key, out = None, None
+                    if self.memoize:
+                        start = time.perf_counter()
+                        key, out = self._memo_lookup(msg)
+                        seconds = time.perf_counter() - start
+                except Exception:
+                    # done will not run for msg
+                    self.router.release(msg)
+                    self.stats.handled(None)
+                    in_flight.release()
+                    raise
+
+                if out is not None:
+                    # through the executor, to keep the replies of a
+                    # trace in order
+                    ex.submit(_replayed, out, seconds).add_done_callback(functools.partial(done, msg, None))
+                else:
+                    ex.submit(handle, msg).add_done_callback(functools.partial(done, msg, key))
+        finally:
+            for ex in executors:
+                ex.shutdown(wait=True)
+
+    def run(self):
+        if self.workers > 1:
+            self.run_concurrent()
+            return
+
+        self.router = self.get_router()
+        self.stats = AgentStats(self.name)
+        self._memo_puts = 0
+        self._memo_lock = threading.Lock()
+        for msg in self.router.recv():
+            self.stats.received(msg)
+            seconds = None
+            try:
+                start = time.perf_counter()
+                key, out = self._memo_lookup(msg) if self.memoize else (None, None)
+                if out is None:
+                    out, seconds = _timed(self.handle_message, msg)
+                    self.send_reply(out)
+                    self._memo_store(key, msg, out)
+                else:
+                    self.send_reply(out)
+                    seconds = time.perf_counter() - start
+            except Exception:
+                self.router.release(msg)
+                raise
+            finally:
+                self.stats.handled(seconds)
+
+            self.router.ack(msg)
 
 class SimpleWorkflowAgent(WorkflowAgent):
     def inject_args(self, parser):
@@ -107,6 +434,120 @@ class SimpleWorkflowAgent(WorkflowAgent):
         self.start(ether, channels)
         return True
 
+class AsyncSimpleAgent(Agent):
+    """A SimpleAgent whose handle_message is a coroutine.
+
+       Each message is handled in its own task, so a single process can
+       wait on many slow operations at once.
+    """
+
+    # default for --kz-max-in-flight
+    max_in_flight = 1000
+
+    def inject_args(self, parser):
+        AgentHelper.inject_kz_args(parser)
+        parser.add_argument("--kz-max-in-flight", type=int, default=self.max_in_flight, help="Stop receiving while this many messages are being handled")
+
+    def setup(self, args):
+        self.max_in_flight = args.kz_max_in_flight
+
+        ether = AgentHelper.get_ether(self.name, args, asynchronous=True)
+        if ether is None:
+            print(f"{self.name} ether setup failed.")
+            return False
+
+        channels = AgentHelper.get_channels(self.name, ether, args)
+        if channels is None:
+            print(f"{self.name}: channel setup failed.")
+            return False
+
+        AgentHelper.init_message(self.name, ether, channels)
+        self.start(ether, channels)
+        return True
+
+    def get_recv_args(self):
+        """Return a tuple containing the arguments to ether.recv"""
+        raise NotImplementedError
+
+    async def handle_message(self, message):
+        """Return None, a message, or a list of messages to send in reply"""
+        raise NotImplementedError
+
+    async def send_reply(self, out):
+        if out is None:
+            return
+
+        if isinstance(out, list):
+            await self.ether.send_many(out)
+        else:
+            await self.ether.send(out)
+
+    async def arun(self):
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        self.stats = AgentStats(self.name)
+
+        async def handle(msg):
+            seconds = None
+            try:
+                start = time.perf_counter()
+                out = await self.handle_message(msg)
+                seconds = time.perf_counter() - start
+                await self.send_reply(out)
+            except Exception as e:
+                print(f"{self.name}: handling message failed: {e!r}", file=sys.stderr)
+            finally:
+                self.stats.handled(seconds)
+                in_flight.release()
+
+        ra = self.get_recv_args()
+        try:
+            async for msg in self.ether.recv(*ra):
+                await in_flight.acquire()
+                self.stats.received(msg)
+                t = asyncio.create_task(handle(msg))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+        finally:
+            if len(tasks):
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self):
+        try:
+            asyncio.run(self.arun())
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down recv loop")
+
+class AsyncSimpleWorkflowAgent(WorkflowAgent):
+    """A SimpleWorkflowAgent that implements arun_interactive as a coroutine"""
+
+    def inject_args(self, parser):
+        AgentHelper.inject_kz_args(parser)
+
+    def setup(self, args):
+        ether = AgentHelper.get_ether(self.name, args, asynchronous=True)
+        if ether is None:
+            print(f"{self.name} ether setup failed.")
+            return False
+
+        channels = AgentHelper.get_channels(self.name, ether, args)
+        if channels is None:
+            print(f"{self.name}: channel setup failed.")
+            return False
+
+        AgentHelper.init_message(self.name, ether, channels)
+        self.start(ether, channels)
+        return True
+
+    async def arun_interactive(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def run_interactive(self, *args, **kwargs):
+        try:
+            asyncio.run(self.arun_interactive(*args, **kwargs))
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down")
+
 def agent_main(agent, run_fn):
     import argparse
 
@@ -0,0 +1,361 @@
+"""Benchmarks for the ethers, run as `kz bench`.
+
+   Results are written as JSON so that runs of different versions can be
+   compared with `kz bench --compare old.json`.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import socket
+import platform
+import tempfile
+import datetime
+import threading
+import subprocess
+import statistics
+
+from yakaizen.core import AsyncMessage, Channel
+from yakaizen.ether_sqlite import SQLiteEther
+from yakaizen.ether_shm import SharedMemoryEther, ring_path
+from yakaizen.ether_sharded import ShardedSQLiteEther
+from yakaizen.ether_proxy import ProxyEther
+
+CHANNEL = Channel('bench')
+SENDER = 'kz-bench'
+DURATION = datetime.timedelta(hours=1)
+
+BENCH_ETHERS = ['sqlite', 'sqlite-group', 'shm', 'sharded', 'proxy-ipc', 'proxy-tcp']
+BENCHES = ['send', 'latency', 'scan', 'rpc']
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class BenchEther:
+    """Creates instances of an ether on a fresh database, starting a proxy
+       server for the proxy ethers"""
+
+    def __init__(self, name, workdir):
+        self.name = name
+        self.database = os.path.join(workdir, name, 'bench.db')
+        os.makedirs(os.path.dirname(self.database))
+        self.server = None
+        self.ethers = []
+
+        if name.startswith('proxy'):
+            if name == 'proxy-ipc':
+                self.address = f'ipc://{os.path.dirname(self.database)}/proxy.ipc'
+            else:
+                self.address = f'tcp://127.0.0.1:{_free_port()}'
+
+            self.server = subprocess.Popen([sys.executable, '-m', 'yakaizen.ether_proxy',
+                                            '--kz-ether', 'sqlite', '--kz-ether-args', self.database,
+                                            self.address],
+                                           stdout=subprocess.DEVNULL)
+            self._wait_listening()
+
+    def _wait_listening(self, timeout = 10):
+        if self.address.startswith('ipc://'):
+            ready = lambda: os.path.exists(self.address[len('ipc://'):])
+        else:
+            host, port = self.address[len('tcp://'):].split(':')
+            def ready():
+                try:
+                    socket.create_connection((host, int(port)), timeout=1).close()
+                    return True
+                except OSError:
+                    return False
+
+        deadline = time.monotonic() + timeout
+        while not ready():
+            assert time.monotonic() < deadline, f"Proxy server did not start on {self.address}"
+            time.sleep(0.05)
+
+    def make(self):
+        if self.name == 'sqlite':
+            e = SQLiteEther(self.database)
+        elif self.name == 'sqlite-group':
+            e = SQLiteEther(self.database, group_commit=True)
+        elif self.name == 'shm':
+            e = SharedMemoryEther(self.database)
+        elif self.name == 'sharded':
+            e = ShardedSQLiteEther(self.database)
+        elif self.name.startswith('proxy'):
+            e = ProxyEther(self.address)
+        else:
+            raise NotImplementedError(self.name)
+
+        self.ethers.append(e)
+        return e
+
+    def close(self):
+        try:
+            for e in self.ethers:
+                e.close()
+        finally:
+            if self.server is not None:
+                self.server.terminate()
+                self.server.wait()
+
+        if self.name == 'shm':
+            for p in (ring_path(self.database), ring_path(self.database) + '.lock'):
+                if os.path.exists(p):
+                    os.remove(p)
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': samples[-1],
+            'mean': statistics.fmean(samples)}
+
+def _flush(e):
+    if hasattr(e, 'flush'):
+        e.flush()
+
+def _msg(type_, contents, trace):
+    return AsyncMessage(CHANNEL, type_, SENDER, contents, [], trace)
+
+def _begin(e):
+    return e.begin_trace('bench', _msg('Bench-Start', '', None), DURATION)
+
+def bench_send(be, args):
+    """Send throughput of one message at a time, batches and concurrent senders"""
+
+    e = be.make()
+    trace = _begin(e)
+    payload = 'x' * args.size
+    results = []
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        e.send(_msg('Bench', payload, trace))
+    _flush(e)
+    results.append(('send_single', {'messages': args.messages}, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for i in range(0, args.messages, args.batch):
+        e.send_many([_msg('Bench', payload, trace) for j in range(min(args.batch, args.messages - i))])
+    _flush(e)
+    results.append(('send_batch', {'messages': args.messages, 'batch': args.batch}, time.perf_counter() - start))
+
+    per_thread = args.messages // args.threads
+
+    def sender():
+        for i in range(per_thread):
+            e.send(_msg('Bench', payload, trace))
+
+    threads = [threading.Thread(target=sender) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    _flush(e)
+    results.append(('send_concurrent', {'messages': per_thread * args.threads, 'threads': args.threads},
+                    time.perf_counter() - start))
+
+    e.end_trace(trace)
+    return [{'bench': name, 'params': dict(params, size=args.size),
+             'metrics': {'seconds': elapsed, 'msgs_per_sec': params['messages'] / elapsed}}
+            for name, params, elapsed in results]
+
+def bench_latency(be, args):
+    """Round trip times of pings answered by an echo thread with its own
+       ether instance"""
+
+    e = be.make()
+    echo = be.make()
+    trace = _begin(e)
+    pongs = queue.Queue()
+
+    def echo_loop():
+        for msg in echo.recv(CHANNEL, trace, ('Ping', 'Stop')):
+            if msg.type_ == 'Stop':
+                break
+            echo.send(_msg('Pong', msg.contents, trace))
+
+    def collect_loop():
+        for msg in e.recv(CHANNEL, trace, ('Pong', 'Stop')):
+            if msg.type_ == 'Stop':
+                break
+            pongs.put(msg.contents)
+
+    threads = [threading.Thread(target=echo_loop, daemon=True), threading.Thread(target=collect_loop, daemon=True)]
+    for t in threads:
+        t.start()
+
+    # recv only sees messages sent after it starts, so ping until both
+    # loops are up
+    for i in range(100):
+        e.send(_msg('Ping', 'warmup', trace))
+        try:
+            pongs.get(timeout=0.1)
+            break
+        except queue.Empty:
+            pass
+
+    time.sleep(0.2)
+    while not pongs.empty():
+        pongs.get()
+
+    samples = []
+    for i in range(args.round_trips):
+        start = time.perf_counter()
+        e.send(_msg('Ping', str(i), trace))
+        while pongs.get(timeout=30) != str(i):
+            pass
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    e.send(_msg('Stop', '', trace))
+    for t in threads:
+        t.join(5)
+
+    e.end_trace(trace)
+    return [{'bench': 'pingpong', 'params': {'round_trips': args.round_trips},
+             'metrics': dict((f'{k}_us', v) for k, v in _percentiles(samples).items())}]
+
+def bench_scan(be, args):
+    """Cost of a non-blocking recv as the database grows"""
+
+    e = be.make()
+    trace = _begin(e)
+    payload = 'x' * args.size
+    results = []
+    count = 0
+    for size in sorted(args.sizes):
+        while count < size:
+            n = min(10000, size - count)
+            e.send_many([_msg('Bench', payload, trace) for i in range(n)])
+            count += n
+        _flush(e)
+
+        # a poll that finds nothing is what an idle agent does all day
+        samples = []
+        for i in range(args.scans):
+            start = time.perf_counter()
+            list(e.recv(CHANNEL, None, ('Bench-Probe',), blocking=False))
+            samples.append((time.perf_counter() - start) * 1e6)
+
+        results.append({'bench': 'recv_scan', 'params': {'messages': size},
+                        'metrics': dict((f'{k}_us', v) for k, v in _percentiles(samples).items())})
+
+    e.end_trace(trace)
+    return results
+
+def bench_rpc(be, args):
+    """Round trip of the cheapest proxy call"""
+
+    if not be.name.startswith('proxy'):
+        return []
+
+    e = be.make()
+    samples = []
+    for i in range(args.round_trips):
+        start = time.perf_counter()
+        e.last_message_id()
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    return [{'bench': 'proxy_rpc', 'params': {'round_trips': args.round_trips},
+             'metrics': dict((f'{k}_us', v) for k, v in _percentiles(samples).items())}]
+
+BENCH_FNS = {'send': bench_send, 'latency': bench_latency, 'scan': bench_scan, 'rpc': bench_rpc}
+
+def run(ethers, benches, args):
+    """Run benches on ethers, returning a list of result records"""
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='kz-bench-', dir=args.dir)
+    try:
+        for name in ethers:
+            for bench in benches:
+                # each bench gets a fresh database
+                be = BenchEther(name, os.path.join(workdir, bench))
+                try:
+                    print(f"Running {bench} on {name}", file=sys.stderr)
+                    for r in BENCH_FNS[bench](be, args):
+                        r['ether'] = name
+                        results.append(r)
+                        print(f"  {r['bench']} {r['params']}: {_summary(r['metrics'])}", file=sys.stderr)
+                finally:
+                    be.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def _summary(metrics):
+    return ', '.join(f'{k}={v:.1f}' for k, v in metrics.items())
+
+def _key(r):
+    return (r['bench'], r['ether'], json.dumps(r['params'], sort_keys=True))
+
+def compare(old, new):
+    """Print the change of every metric present in both runs to stderr"""
+
+    old_results = dict((_key(r), r) for r in old['results'])
+    for r in new['results']:
+        o = old_results.get(_key(r))
+        if o is None:
+            continue
+
+        changes = []
+        for k, v in r['metrics'].items():
+            if k in o['metrics'] and o['metrics'][k]:
+                changes.append(f"{k} {100 * (v - o['metrics'][k]) / o['metrics'][k]:+.1f}%")
+
+        print(f"{r['bench']} {r['ether']} {r['params']}: {', '.join(changes)}", file=sys.stderr)
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('yakaizen')
+    except Exception:
+        return None
+
+def main(argv = None):
+    import argparse
+
+    p = argparse.ArgumentParser(prog='kz bench', description='Measure the throughput and latency of ethers')
+    p.add_argument('--ether', action='append', choices=BENCH_ETHERS, help='Ether to benchmark, may be repeated, default all')
+    p.add_argument('--bench', action='append', choices=BENCHES, help='Benchmark to run, may be repeated, default all')
+    p.add_argument('--messages', type=int, default=2000, help='Messages sent by each send benchmark')
+    p.add_argument('--batch', type=int, default=100, help='Messages per send_many')
+    p.add_argument('--threads', type=int, default=8, help='Concurrent senders')
+    p.add_argument('--size', type=int, default=100, help='Bytes of contents per message')
+    p.add_argument('--round-trips', type=int, default=500, help='Round trips for latency and rpc')
+    p.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[1000, 10000, 100000],
+                   help='Comma-separated database sizes for scan, up to 10000000')
+    p.add_argument('--scans', type=int, default=50, help='Polls measured at each database size')
+    p.add_argument('--dir', help='Directory for the databases, default is the system temporary directory')
+    p.add_argument('-o', '--output', help='Write results to this file instead of stdout')
+    p.add_argument('--compare', metavar='OLD', help='Compare with results of an earlier run')
+
+    args = p.parse_args(argv)
+
+    results = run(args.ether or BENCH_ETHERS, args.bench or BENCHES, args)
+    out = {'version': 1,
+           'yakaizen': _version(),
+           'date': datetime.datetime.now().isoformat(),
+           'host': {'name': platform.node(), 'python': platform.python_version(),
+                    'platform': platform.platform(), 'cpus': os.cpu_count()},
+           'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+           'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+    else:
+        json.dump(out, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), out)
+
+if __name__ == "__main__":
+    main()
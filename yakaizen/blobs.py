@@ -0,0 +1,117 @@
+import os
+import re
+import hashlib
+import tempfile
+import mmap
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+HASH_RE = re.compile('[0-9a-f]{64}')
+
+class BlobWriter:
+    """Writes a blob incrementally, hashing it as it goes"""
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp = tempfile.mkstemp(dir=store.path, prefix='.tmp-')
+        self._f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self._hash.update(data)
+        self._f.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """Move the blob into the store and return (hash, size)"""
+
+        self._f.close()
+        h = self._hash.hexdigest()
+        dst = self.store.blob_path(h)
+
+        if os.path.exists(dst):
+            # identical contents are already stored, touch it so that it is
+            # not garbage collected before the new reference is committed
+            os.unlink(self._tmp)
+            os.utime(dst)
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(self._tmp, dst)
+
+        return (h, self.size)
+
+    def abort(self):
+        self._f.close()
+        try:
+            os.unlink(self._tmp)
+        except OSError:
+            pass
+
+class BlobStore:
+    """A content-addressed store of files, kept next to the database.
+
+       Blobs are named by their SHA-256 hash, so identical blobs are
+       only stored once.
+    """
+
+    def __init__(self, path, create = True):
+        self.path = str(path)
+        if create:
+            os.makedirs(self.path, exist_ok=True)
+
+    def blob_path(self, h):
+        # hashes come from clients of the proxy, so must not name a path
+        # outside the store
+        if not isinstance(h, str) or HASH_RE.fullmatch(h) is None:
+            raise ValueError(f"Invalid blob hash {h!r}")
+
+        return os.path.join(self.path, h[:2], h)
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def put(self, f):
+        """Store the contents of the binary file object f, return (hash, size)"""
+
+        w = self.writer()
+        try:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                w.write(data)
+        except BaseException:
+            w.abort()
+            raise
+
+        return w.commit()
+
+    def exists(self, h):
+        return os.path.exists(self.blob_path(h))
+
+    def open(self, h):
+        return open(self.blob_path(h), 'rb')
+
+    def read(self, h, offset, length):
+        with self.open(h) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def mmap(self, h):
+        with self.open(h) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, h, grace = 0):
+        """Delete a blob, unless it was stored or reused in the last grace seconds"""
+        try:
+            if grace > 0 and os.path.getmtime(self.blob_path(h)) > time.time() - grace:
+                return
+
+            os.unlink(self.blob_path(h))
+        except FileNotFoundError:
+            pass
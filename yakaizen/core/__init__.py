@@ -1,3 +1,13 @@
+import os
+import io
+import sys
+import json
+import pathlib
+import tarfile
+import tempfile
+import weakref
+import threading
+
 
 class Ether:
     """A medium for communication"""
@@ -8,17 +18,89 @@ class Ether:
     def send(self, msg):
         raise NotImplementedError
 
+    def send_many(self, msgs):
+        for msg in msgs:
+            self.send(msg)
+
+    def get_contents(self, message_ids):
+        """Return a dictionary mapping message ids to contents"""
+        raise NotImplementedError
+
+    def get_attachments(self, message_ids):
+        """Return a dictionary mapping message ids to lists of attachments"""
+        raise NotImplementedError
+
+    def fetch_contents(self, msgs):
+        """Load the contents of header-only messages in a single batch"""
+        pending = [m for m in msgs if isinstance(m, MessageHeader) and not m.contents_loaded]
+        if len(pending) == 0:
+            return
+
+        contents = self.get_contents([m.message_id for m in pending])
+        for m in pending:
+            m.contents = contents.get(m.message_id)
+
+    def fetch_attachments(self, msgs):
+        """Load the attachments of header-only messages in a single batch"""
+        pending = [m for m in msgs if isinstance(m, MessageHeader) and not m.attachments_loaded]
+        if len(pending) == 0:
+            return
+
+        attachments = self.get_attachments([m.message_id for m in pending if m.has_attachments])
+        for m in pending:
+            m.attachments = attachments.get(m.message_id, [])
+            for att in m.attachments:
+                att.message = m
+
     def recv(self, trace, msg_types, sender_set):
         raise NotImplementedError
 
+    def claim(self, group, subscription, owner, lease = 60, limit = 1, max_attempts = None, headers_only = False, timeout = 0):
+        """Claim up to limit messages matching subscription for owner, for
+           lease seconds, waiting up to timeout seconds for one to arrive.
+
+           Every message sent after the group was first used is claimed
+           by exactly one owner at a time. Messages that are not acked
+           before their lease runs out are claimed again, up to
+           max_attempts times."""
+        raise NotImplementedError
+
+    def ack(self, group, owner, message_ids):
+        """Mark claimed messages as handled, returning how many were still
+           claimed by owner"""
+        raise NotImplementedError
+
+    def release(self, group, owner, message_ids):
+        """Give up claims so the messages can be claimed again at once"""
+        raise NotImplementedError
+
+    def extend_lease(self, group, owner, message_ids, lease):
+        """Renew claims for lease seconds from now"""
+        raise NotImplementedError
+
+    def memo_get(self, key, max_age = None):
+        """Return the bytes stored under key by memo_put, or None if there
+           are none or they are older than max_age seconds"""
+        raise NotImplementedError
+
+    def memo_put(self, key, owner, value):
+        """Store bytes under key on behalf of owner, e.g. an agent"""
+        raise NotImplementedError
+
+    def memo_evict(self, owner, max_bytes = None, max_age = None):
+        """Drop the values of owner older than max_age seconds, then the
+           least recently used until they take up at most max_bytes,
+           returning how many were dropped"""
+        raise NotImplementedError
+
     def start(self):
         raise NotImplementedError
 
     def stop(self):
         raise NotImplementedError
 
-    def post(self, posting):
-        raise NotImplementedError
+    def post(self, name, value):
+        return self.postings.put(name, value)
 
     def register(self, agent):
         raise NotImplementedError
@@ -29,9 +111,49 @@ class Ether:
     def begin_trace(self, msg):
         raise NotImplementedError
 
+    def ancestors(self, message_id):
+        raise NotImplementedError
+
+    def descendants(self, message_id):
+        raise NotImplementedError
+
+    def frontier(self, trace):
+        raise NotImplementedError
+
+    def trace_dag(self, trace):
+        raise NotImplementedError
+
     def end_trace(self, trace):
         raise NotImplementedError
 
+class AsyncEther:
+    """An ether whose operations are coroutines, recv is an async generator"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def send(self, msg):
+        raise NotImplementedError
+
+    async def send_many(self, msgs):
+        for msg in msgs:
+            await self.send(msg)
+
+    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False):
+        raise NotImplementedError
+
+    async def begin_trace(self, name, msg, duration):
+        raise NotImplementedError
+
+    async def end_trace(self, trace):
+        raise NotImplementedError
+
+    async def fetch_contents(self, msgs):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
 class Channel:
     def __init__(self, name: str):
         self.name = name
@@ -41,11 +163,101 @@ class Channel:
 
     __repr__ = __str__
 
+class Subscription:
+    """Selects messages on a channel, optionally of a trace, of some types
+       and from some senders, like the arguments of Ether.recv"""
+
+    def __init__(self, channel, trace = None, msg_types = None, sender_set = None):
+        self.channel = channel
+        self.trace = trace
+        self.msg_types = msg_types
+        self.sender_set = sender_set
+
+    def matches(self, msg):
+        channel = msg.channel.name if isinstance(msg.channel, Channel) else msg.channel
+        return (channel == self.channel.name
+                and (self.trace is None or msg.trace.trace_id == self.trace.trace_id)
+                and (self.msg_types is None or msg.type_ in self.msg_types)
+                and (self.sender_set is None or msg.sender in self.sender_set))
+
+    def __str__(self):
+        return f"Subscription({self.channel}, {self.trace.trace_id if self.trace else '-'}, {self.msg_types}, {self.sender_set})"
+
+    __repr__ = __str__
+
 CHANNEL_PROD = Channel("prod")
 CHANNEL_DEBUG = Channel("debug")
 
 class Router:
-    pass
+    """Obtains the messages an agent handles from the Ether.
+
+       Agents iterate over recv() and ack each message once it has been
+       handled, or release it if handling failed.
+    """
+
+    def __init__(self, ether, *args, **kwargs):
+        self.ether = ether
+
+    def recv(self):
+        raise NotImplementedError
+
+    def ack(self, msg):
+        pass
+
+    def release(self, msg):
+        pass
+
+class BroadcastRouter(Router):
+    """Delivers every matching message, takes the arguments of Ether.recv"""
+
+    def __init__(self, ether, *recv_args, **recv_kwargs):
+        super().__init__(ether)
+        self.recv_args = recv_args
+        self.recv_kwargs = recv_kwargs
+
+    def recv(self):
+        yield from self.ether.recv(*self.recv_args, **self.recv_kwargs)
+
+class WorkQueueRouter(Router):
+    """Shares the matching messages among all routers of a group, each
+       message is handled by one of them.
+
+       Messages are claimed from the ether for lease seconds. A message
+       that is not acked in time, e.g. because its handler crashed, is
+       delivered again, up to max_attempts times.
+    """
+
+    def __init__(self, ether, group, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False,
+                 lease = 60, batch = 1, max_attempts = None, owner = None):
+        super().__init__(ether)
+        self.group = group
+        self.subscription = Subscription(channel, trace, msg_types, sender_set)
+        self.blocking = blocking
+        self.headers_only = headers_only
+        self.lease = lease
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.owner = owner or f'{os.uname().nodename}:{os.getpid()}:{id(self)}'
+
+    def recv(self):
+        try:
+            while True:
+                msgs = self.ether.claim(self.group, self.subscription, self.owner, self.lease,
+                                        self.batch, self.max_attempts, self.headers_only,
+                                        timeout=30 if self.blocking else 0)
+                yield from msgs
+
+                if not self.blocking and len(msgs) == 0:
+                    break
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down recv loop")
+
+    def ack(self, msg):
+        if self.ether.ack(self.group, self.owner, [msg.message_id]) == 0:
+            print(f"WARNING: lease on message {msg.message_id} ran out before it was acked, it may be handled twice", file=sys.stderr)
+
+    def release(self, msg):
+        self.ether.release(self.group, self.owner, [msg.message_id])
 
 class Agent:
     def __init__(self, *args, **kwargs):
@@ -67,11 +279,66 @@ class WorkflowAgent(Agent):
         raise NotImplementedError
 
 class Postings:
+    """Long-lived named values, independent of any message, e.g.
+       configuration or the best result of a search so far.
+
+       Every update of a posting gives it a new version, a posting that
+       does not exist has version 0. Reads are cached, subclasses
+       implement _refresh to drop entries that have newer versions.
+    """
+
     def __init__(self, *args, **kwargs):
-        pass
+        self._cache = {}
+        self._stamp = None # highest version the cache was checked against
+        self._lock = threading.Lock()
 
-    def post(self):
-        pass
+    def _read(self, name):
+        """Return (value, version) of a posting, bypassing the cache"""
+        raise NotImplementedError
+
+    def _refresh(self):
+        raise NotImplementedError
+
+    def _invalidate(self, names):
+        for name in names:
+            self._cache.pop(name, None)
+
+    def get_versioned(self, name):
+        """Return (value, version)"""
+        with self._lock:
+            self._refresh()
+            hit = self._cache.get(name)
+
+        if hit is None:
+            stamp = self._stamp
+            hit = self._read(name)
+            with self._lock:
+                # a refresh during the read may have missed this entry
+                if self._stamp == stamp:
+                    self._cache[name] = hit
+
+        return hit
+
+    def get(self, name, default = None):
+        value, version = self.get_versioned(name)
+        return default if version == 0 else value
+
+    def put(self, name, value, type_ = None):
+        """Set a posting, returning its new version"""
+        raise NotImplementedError
+
+    def cas(self, name, value, version, type_ = None):
+        """Set a posting only if its version is still version, returning the
+           new version or None if it was changed by someone else"""
+        raise NotImplementedError
+
+    def watch(self, name, version = 0, timeout = 30):
+        """Wait up to timeout seconds for a posting to have a version other
+           than version, returning (value, version)"""
+        raise NotImplementedError
+
+    def post(self, name, value):
+        return self.put(name, value)
 
 class AsyncMessage:
     def __init__(self, channel, type_, sender, contents, sources, trace, *args, **kwargs):
@@ -89,7 +356,7 @@ class AsyncMessage:
         self.sources_ = sources if sources is not None else []
         self.message_id = None
 
-        src_trace_ids = set([s.trace_id for s in sources])
+        src_trace_ids = set([s.trace.trace_id for s in self.sources_])
         assert len(src_trace_ids) <= 1, f"Cannot have sources from different traces!"
 
     def attach(self, attachment):
@@ -102,6 +369,54 @@ class AsyncMessage:
     def sources(self):
         return self.sources_
 
+class MessageHeader(AsyncMessage):
+    """A message received without its contents and attachments.
+
+       These are fetched from the ether on first access, use
+       Ether.fetch_contents to fetch them for many messages at once.
+    """
+
+    def __init__(self, ether, channel, type_, sender, size, has_attachments, trace, *args, **kwargs):
+        super().__init__(channel, type_, sender, None, [], trace, *args, **kwargs)
+        self._ether = ether
+        self.size = size
+        self.has_attachments = has_attachments
+        self.contents_loaded = False
+        self.attachments_loaded = not has_attachments
+
+    @property
+    def contents(self):
+        if not self.contents_loaded:
+            self._ether.fetch_contents([self])
+
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        self._contents = value
+        self.contents_loaded = True
+
+    @property
+    def attachments(self):
+        if not self.attachments_loaded:
+            self._ether.fetch_attachments([self])
+
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, value):
+        self._attachments = value
+        self.attachments_loaded = True
+
+    def __getstate__(self):
+        # the ether is rebound by the receiver
+        state = self.__dict__.copy()
+        state['_ether'] = None
+        return state
+
+    def __str__(self):
+        return f"MessageHeader({self.channel}, {self.trace.trace_id if self.trace else '-'}, {self.message_id}, {str(self.sender)}, {self.type_}, {self.size})"
+
 class SystemMessage(AsyncMessage):
     pass
 
@@ -112,19 +427,67 @@ class SysRestart(SystemMessage):
     pass
 
 class Attachment:
+    """Data attached to a message.
+
+       contents can be bytes, a str, or a path to a file. Files are
+       streamed into the ether when the message is sent, and are never
+       read into memory as a whole. Received attachments only carry the
+       hash and size of their data, use open() to stream it.
+    """
+
     def __init__(self, message, type_, contents, *args, **kwargs):
         self.message = message
         self.type_ = type_
         self.contents = contents
+        self.hash = None
+        self._store = None
+
+        if contents is None:
+            self.size = None
+        elif isinstance(contents, os.PathLike):
+            self.size = os.path.getsize(contents)
+        else:
+            self.size = len(self._as_bytes())
+
+    def _as_bytes(self):
+        if isinstance(self.contents, str):
+            return self.contents.encode('utf-8')
+
+        return self.contents
 
     def __str__(self):
-        return f"{self.__class__.__name__}({str(self.message)}, {self.type_}, {len(self.contents)})"
+        return f"{self.__class__.__name__}({str(self.message)}, {self.type_}, {self.size})"
 
     __repr__ = __str__
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        if self.hash is not None:
+            # already stored, receivers read it through the ether
+            state['contents'] = None
+        return state
+
+    def open(self):
+        """Return a binary file object for the attachment's data"""
+
+        if self.contents is not None:
+            if isinstance(self.contents, os.PathLike):
+                return open(self.contents, 'rb')
+
+            return io.BytesIO(self._as_bytes())
+
+        assert self._store is not None, f"Attachment has no data"
+        return self._store.open(self.hash)
+
+    def mmap(self):
+        """Memory-map the attachment's data, only available on local ethers"""
+        return self._store.mmap(self.hash)
+
     @property
     def data(self):
-        return self._data
+        with self.open() as f:
+            return f.read()
 
 class Blob(Attachment):
     pass
@@ -134,12 +497,45 @@ class ArchiveBlob(Attachment):
        files and directories around.
     """
 
-    @staticmethod
-    def package(self, files):
-        pass
+    @classmethod
+    def package(cls, message, type_, files):
+        """Package files and directories into a compressed archive.
+
+           The archive is written to a temporary file that is removed when
+           the attachment is garbage collected.
+        """
+
+        fd, path = tempfile.mkstemp(suffix='.tar.gz')
+        with os.fdopen(fd, 'wb') as f:
+            with tarfile.open(fileobj=f, mode='w:gz') as tf:
+                for fn in files:
+                    tf.add(fn, arcname=os.path.basename(os.path.normpath(fn)))
+
+        blob = cls(message, type_, pathlib.Path(path))
+        weakref.finalize(blob, os.unlink, path)
+        return blob
 
     def unpack(self, destination):
-        pass
+        with self.open() as f:
+            with tarfile.open(fileobj=f, mode='r|gz') as tf:
+                tf.extractall(destination, filter='data')
+
+class ResourceConsumption(Attachment):
+    """Resources used to produce a message, stored as a JSON object such
+       as the usage of a job run by yakaizen.utils.executor"""
+
+    @classmethod
+    def from_usage(cls, message, usage, type_ = 'resource-consumption'):
+        return cls(message, type_, json.dumps(usage))
+
+    @property
+    def usage(self):
+        return json.loads(self.data)
+
+ATTACHMENT_KINDS = {'Attachment': Attachment,
+                    'Blob': Blob,
+                    'ArchiveBlob': ArchiveBlob,
+                    'ResourceConsumption': ResourceConsumption}
 
 class Trace:
     """A DAG of messages"""
@@ -0,0 +1,228 @@
+"""Asyncio versions of the SQLite and proxy ethers.
+
+   These let a single event loop drive thousands of concurrent traces,
+   instead of dedicating a thread to each blocked recv.
+"""
+
+import asyncio
+import functools
+import concurrent.futures
+
+from .core import AsyncEther, Subscription
+from .ether_sqlite import SQLiteEther
+from .ether_proxy import ProxyEther, POLL_TIMEOUT
+from . import wire
+
+class AsyncSQLiteEther(AsyncEther):
+    """Runs SQLiteEther queries on a small thread pool.
+
+       All recv generators of an ether share one notifier socket, which
+       is watched by the event loop, so waiting costs no threads.
+    """
+
+    def __init__(self, database, *args, threads = 4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ether = SQLiteEther(database, *args, **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='kz-async-sqlite')
+        self._listener = None
+        self._loop = None
+        self._changed = None
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def send(self, msg):
+        await self._run(self.ether.send, msg)
+
+    async def send_many(self, msgs):
+        await self._run(self.ether.send_many, msgs)
+
+    async def begin_trace(self, name, msg, duration):
+        return await self._run(self.ether.begin_trace, name, msg, duration)
+
+    async def end_trace(self, trace):
+        await self._run(self.ether.end_trace, trace)
+
+    async def last_message_id(self):
+        return await self._run(self.ether.last_message_id)
+
+    async def fetch_contents(self, msgs):
+        await self._run(self.ether.fetch_contents, msgs)
+
+    async def fetch_attachments(self, msgs):
+        await self._run(self.ether.fetch_attachments, msgs)
+
+    def _watch(self):
+        if self._changed is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        if self.ether._notifier is not None:
+            self._listener = self.ether._notifier.listen()
+            if self._listener is not None:
+                self._loop.add_reader(self._listener.sock, self._wake)
+
+    def _wake(self):
+        self._listener.drain()
+
+        # waiters hold on to the event they saw before polling, so a
+        # wake-up between their poll and their wait is not lost
+        changed = self._changed
+        self._changed = asyncio.Event()
+        changed.set()
+
+    async def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False, _after = None):
+        """Receive messages, see SQLiteEther.recv"""
+
+        async for msg in self._recv([Subscription(channel, trace, msg_types, sender_set)],
+                                    blocking, headers_only, _after):
+            yield msg
+
+    async def recv_multi(self, subscriptions, blocking = True, headers_only = False, _after = None):
+        """Receive messages of several subscriptions, see SQLiteEther.recv_multi"""
+
+        subscriptions = list(subscriptions)
+        async for msg in self._recv(subscriptions, blocking, headers_only, _after):
+            for sub in subscriptions:
+                if sub.matches(msg):
+                    yield (sub, msg)
+
+    async def _recv(self, subscriptions, blocking, headers_only, _after):
+        self._watch()
+
+        traces_cache = {}
+        query, values = self.ether._recv_query(subscriptions, headers_only)
+        values['after'] = _after if _after is not None else await self.last_message_id()
+
+        while True:
+            changed = self._changed
+            rows = await self._run(self.ether._poll, query, values, headers_only, traces_cache)
+
+            for msg in rows:
+                yield msg
+
+            if len(rows) > 0:
+                values['after'] = rows[-1].message_id
+
+            if not blocking:
+                break
+
+            if len(rows) == 0:
+                # the poll interval is a fallback for writers on other hosts
+                try:
+                    await asyncio.wait_for(changed.wait(), self.ether.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def close(self):
+        if self._listener is not None:
+            self._loop.remove_reader(self._listener.sock)
+            self._listener.close()
+            self._listener = None
+
+        self._executor.shutdown(wait=True)
+        self.ether.close()
+
+class AsyncProxyEther(AsyncEther):
+    """Talks to a proxy server using the wire protocol.
+
+       Every call uses its own Req0 context, so calls from different
+       tasks run concurrently. Lazy loads of message headers and blob
+       transfers go through a synchronous ProxyEther.
+    """
+
+    def __init__(self, dial_addr, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sync = ProxyEther(dial_addr, protocol='wire')
+        self.proxy = self.sync.proxy
+
+    async def _call(self, cmd, *args, **kwargs):
+        """Call cmd on the proxy, raising the exception it failed with.
+           Returns None if the reply was malformed."""
+
+        ctx = self.proxy.new_context()
+        try:
+            await ctx.asend(wire.encode_call(cmd, *args, **kwargs))
+            return wire.decode_ret(await ctx.arecv())
+        except wire.WireError as e:
+            print(f"ERROR: received malformed return value for {cmd}: {e}")
+            return None
+        finally:
+            ctx.close()
+
+    async def _store_attachments(self, msgs):
+        if any(att.hash is None for msg in msgs for att in msg.attachments):
+            await asyncio.to_thread(self.sync._store_attachments, msgs)
+
+    async def send(self, msg):
+        await self._store_attachments([msg])
+        msg.message_id = await self._call('send', msg)
+
+    async def send_many(self, msgs):
+        await self._store_attachments(msgs)
+        ret = await self._call('send_many', list(msgs))
+        if ret is None:
+            return None
+
+        for msg, message_id in zip(msgs, ret):
+            msg.message_id = message_id
+
+    async def begin_trace(self, name, msg, duration):
+        await self._store_attachments([msg])
+        ret = await self._call('begin_trace', name, msg, duration)
+        if ret is None:
+            return None
+
+        msg.trace = ret[0]
+        msg.message_id = ret[1]
+        return ret[0]
+
+    async def end_trace(self, trace):
+        await self._call('end_trace', trace)
+        trace.active = False
+
+    async def last_message_id(self):
+        return await self._call('last_message_id')
+
+    async def fetch_contents(self, msgs):
+        await asyncio.to_thread(self.sync.fetch_contents, msgs)
+
+    async def fetch_attachments(self, msgs):
+        await asyncio.to_thread(self.sync.fetch_attachments, msgs)
+
+    async def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False):
+        """Receive messages through a subscription, see ProxyEther.recv"""
+
+        after = await self.last_message_id()
+        sub_id = None
+        try:
+            while True:
+                if sub_id is None:
+                    sub_id = await self._call('subscribe', channel, trace, msg_types,
+                                              sender_set=sender_set,
+                                              headers_only=headers_only)
+                    if sub_id is None:
+                        raise RuntimeError("Proxy server does not support subscriptions, it may be older than this client")
+
+                ret = await self._call('poll', sub_id, after, POLL_TIMEOUT if blocking else 0)
+                if ret is None:
+                    sub_id = None
+                    continue
+
+                for r in ret:
+                    self.sync._bind(r)
+                    yield r
+
+                if len(ret):
+                    after = ret[-1].message_id
+
+                if not blocking:
+                    break
+        finally:
+            if sub_id is not None:
+                await self._call('unsubscribe', sub_id)
+
+    def close(self):
+        self.sync.close()
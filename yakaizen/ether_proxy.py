@@ -1,15 +1,37 @@
+import sys
 import sqlite3
 import datetime
 import time
 import pynng
 from collections import namedtuple
 import pickle
-
-from .core import Ether, Trace, AsyncMessage
-from .ether_sqlite import SQLiteEther
+import hashlib
+import io
+import itertools
+import threading
+import weakref
+import concurrent.futures
+
+from .core import Ether, Trace, AsyncMessage, MessageHeader, Subscription, Postings
+from .ether_sqlite import SQLiteEther, s2dt
+from .blobs import CHUNK_SIZE
+from . import wire
+from . import metrics
 
 CMD = namedtuple('CMD', 'cmd payload')
 
+# commands that write to the database, these are run on a single thread
+WRITE_CMDS = set(['send', 'send_many', 'begin_trace', 'end_trace', 'posting_put', 'posting_cas',
+                  'ack', 'release', 'extend_lease', 'memo_put', 'memo_evict'])
+
+# longest time a subscription poll waits on the server, this must stay
+# below nng's request resend time (60s)
+POLL_TIMEOUT = 30
+
+# subscriptions that are not polled for this many seconds are dropped,
+# their clients resubscribe if they come back
+SUB_TIMEOUT = 2 * POLL_TIMEOUT
+
 def _encode(cmd, *args, **kwargs):
     payload = pickle.dumps({'args': args, 'kwargs': kwargs})
     return pickle.dumps(CMD(cmd, payload))
@@ -17,49 +39,365 @@ def _encode(cmd, *args, **kwargs):
 def _decode(payload):
     return pickle.loads(payload)
 
+class _ProxySub:
+    def __init__(self, subscription, headers_only, start):
+        self.subscription = subscription
+        self.headers_only = headers_only
+        self.start = start # the dispatcher has scanned messages up to here
+        self.pending = []
+        self.last_poll = time.monotonic()
+
 class SQLiteProxyEther(Ether):
-    def __init__(self, listen_addr, database, *args, **kwargs):
+    """Serves an SQLiteEther to ProxyEther clients.
+
+       Requests are handled concurrently by a pool of threads, each with
+       its own database connection for reads. The pool keeps at least
+       `workers` threads idle, growing while requests (usually
+       subscription polls) are waiting. Writes are handed to a single
+       writer thread so they share one connection and never contend for
+       the write lock.
+
+       Subscriptions are served by a dispatcher thread that scans new
+       messages for all of them with one query per wake-up, so agents on
+       the same host can share a proxy (e.g. on an ipc:// address) and
+       the database sees a single reader.
+    """
+
+    def __init__(self, listen_addr, database, *args, workers = 8, **kwargs):
         self.ethsq = SQLiteEther(database, *args, **kwargs)
         self.listen_addr = listen_addr
+        self.workers = workers
+        self._uploads = {}
+        self._upload_ids = itertools.count()
+        self._subs = {}
+        self._sub_ids = itertools.count()
+        self._subs_cond = threading.Condition()
+        self._cursor = self.ethsq.last_message_id()
+        self._idle = 0
+        self._idle_lock = threading.Lock()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='kz-proxy-writer')
+
+    def _dispatch(self, cmd, args, kwargs):
+        if cmd == 'recv':
+            return list(self.ethsq.recv(*args, **kwargs, blocking=False))
+        elif cmd == 'send':
+            self.ethsq.send(*args, **kwargs)
+            return args[0].message_id
+        elif cmd == 'send_many':
+            self.ethsq.send_many(*args, **kwargs)
+            return [m.message_id for m in args[0]]
+        elif cmd == 'begin_trace':
+            msg = args[1]
+            ret = self.ethsq.begin_trace(*args, **kwargs)
+            return (ret, msg.message_id)
+        elif cmd == 'get_contents':
+            return self.ethsq.get_contents(*args, **kwargs)
+        elif cmd == 'get_attachments':
+            return self.ethsq.get_attachments(*args, **kwargs)
+        elif cmd in ('ancestors', 'descendants', 'frontier', 'trace_dag'):
+            return getattr(self.ethsq, cmd)(*args, **kwargs)
+        elif cmd == 'blob_exists':
+            return self.ethsq.blobs.exists(*args)
+        elif cmd == 'blob_begin':
+            upload_id = next(self._upload_ids)
+            self._uploads[upload_id] = self.ethsq.blobs.writer()
+            return upload_id
+        elif cmd == 'blob_write':
+            upload_id, data = args
+            self._uploads[upload_id].write(data)
+            return None
+        elif cmd == 'blob_commit':
+            return self._uploads.pop(args[0]).commit()
+        elif cmd == 'blob_read':
+            return self.ethsq.blobs.read(*args)
+        elif cmd == 'subscribe':
+            sub = Subscription(*args, sender_set=kwargs.get('sender_set'))
+            with self._subs_cond:
+                sub_id = next(self._sub_ids)
+                self._subs[sub_id] = _ProxySub(sub, kwargs.get('headers_only', False), self._cursor)
+            return sub_id
+        elif cmd == 'poll':
+            return self._poll_sub(*args)
+        elif cmd == 'unsubscribe':
+            with self._subs_cond:
+                self._subs.pop(args[0], None)
+            return None
+        elif cmd == 'last_message_id':
+            return self.ethsq.last_message_id()
+        elif cmd == 'end_trace':
+            self.ethsq.end_trace(*args, **kwargs)
+            return None
+        elif cmd == 'claim':
+            # claims write, but may wait, so they do not go to the writer
+            group, channel, trace, msg_types, sender_set, owner = args
+            kwargs['timeout'] = min(kwargs.get('timeout', 0), POLL_TIMEOUT)
+            return self.ethsq.claim(group, Subscription(channel, trace, msg_types, sender_set), owner, **kwargs)
+        elif cmd in ('ack', 'release', 'extend_lease', 'memo_get', 'memo_put', 'memo_evict'):
+            return getattr(self.ethsq, cmd)(*args)
+        elif cmd == 'posting_get':
+            return self.ethsq.postings._read(*args)
+        elif cmd == 'posting_put':
+            return self.ethsq.postings.put(*args, **kwargs)
+        elif cmd == 'posting_cas':
+            return self.ethsq.postings.cas(*args, **kwargs)
+        elif cmd == 'posting_watch':
+            name, version, timeout = args
+            return self.ethsq.postings.watch(name, version, min(timeout, POLL_TIMEOUT))
+        elif cmd == 'postings_changes':
+            return self.ethsq.postings.changes(*args)
+        elif cmd == 'postings_wait':
+            stamp, timeout = args
+            return self.ethsq.postings.wait_changes(stamp, min(timeout, POLL_TIMEOUT))
+        else:
+            print("Unhandled ", cmd)
+            return None
 
-    def _dispatch(self, cmd):
-        if cmd.cmd == 'recv':
-            p = _decode(cmd.payload)
-            rv = list(self.ethsq.recv(*p['args'], **p['kwargs'], blocking=False))
-            return CMD('ret', rv)
-        elif cmd.cmd == 'send':
-            p = _decode(cmd.payload)
-            self.ethsq.send(*p['args'], **p['kwargs'])
-            return CMD('ret', p['args'][0].message_id)
-        elif cmd.cmd == 'begin_trace':
-            p = _decode(cmd.payload)
-            msg = p['args'][1]
-            ret = self.ethsq.begin_trace(*p['args'], **p['kwargs'])
-            return CMD('ret', (ret, msg.message_id))
-        elif cmd.cmd == 'end_trace':
-            p = _decode(cmd.payload)
-            self.ethsq.end_trace(*p['args'], **p['kwargs'])
-            return CMD('ret', None)
+    def _poll_sub(self, sub_id, after, timeout):
+        """Return the messages of a subscription after the cursor `after`,
+           waiting up to timeout seconds. Returns None for an unknown
+           subscription, e.g. if the proxy was restarted."""
+
+        deadline = time.monotonic() + min(timeout, POLL_TIMEOUT)
+        rows = []
+        while True:
+            with self._subs_cond:
+                ps = self._subs.get(sub_id)
+                if ps is None:
+                    return None
+
+                ps.last_poll = time.monotonic()
+
+                # messages up to the client's cursor were received, so are
+                # not sent again
+                ps.pending = [m for m in ps.pending if m.message_id > after]
+                start = ps.start
+
+                if after >= start:
+                    remaining = deadline - time.monotonic()
+                    if len(rows) or len(ps.pending) or remaining <= 0:
+                        return rows + ps.pending
+
+                    self._subs_cond.wait(remaining)
+                    continue
+
+            # the dispatcher only looks at messages after start, so catch up
+            # on earlier messages directly
+            rows.extend(self.ethsq.wait_recv_multi([ps.subscription], after=after, upto=start,
+                                                   timeout=0, headers_only=ps.headers_only))
+            after = start
+
+    def _dispatch_subs(self):
+        """Scan new messages for all subscriptions, one query per wake-up"""
+
+        notifier = self.ethsq._notifier
+        listener = notifier.listen() if notifier else None
+        try:
+            while True:
+                with self._subs_cond:
+                    now = time.monotonic()
+                    for sub_id in [k for k, ps in self._subs.items() if now - ps.last_poll > SUB_TIMEOUT]:
+                        del self._subs[sub_id]
+
+                    subs = dict(self._subs)
+                    after = self._cursor
+
+                upto = self.ethsq.last_message_id()
+                if upto > after:
+                    found = []
+                    for headers_only in (False, True):
+                        group = [ps for ps in subs.values() if ps.headers_only == headers_only]
+                        if len(group):
+                            msgs = self.ethsq.wait_recv_multi([ps.subscription for ps in group],
+                                                              after=after, upto=upto, timeout=0,
+                                                              headers_only=headers_only)
+                            found.append((group, msgs))
+
+                    with self._subs_cond:
+                        for group, msgs in found:
+                            for msg in msgs:
+                                for ps in group:
+                                    if ps.subscription.matches(msg):
+                                        ps.pending.append(msg)
+
+                        # subscriptions made during the scan catch up directly
+                        for sub_id, ps in self._subs.items():
+                            if sub_id not in subs:
+                                ps.start = upto
+
+                        self._cursor = upto
+                        self._subs_cond.notify_all()
+
+                # the poll interval is a fallback for writers on other hosts
+                if listener is not None:
+                    listener.wait(self.ethsq.poll_interval)
+                else:
+                    time.sleep(self.ethsq.poll_interval)
+        finally:
+            if listener is not None:
+                listener.close()
+
+    def _run(self, cmd, args, kwargs):
+        start = time.perf_counter()
+        if cmd in WRITE_CMDS:
+            ret = self._writer.submit(self._dispatch, cmd, args, kwargs).result()
         else:
-            print("Unhandled ", cmd.cmd)
-            return CMD('ret', None)
+            ret = self._dispatch(cmd, args, kwargs)
+
+        metrics.observe('kz_proxy_request_seconds', time.perf_counter() - start, cmd=cmd)
+        return ret
+
+    def _handle(self, frame):
+        """Handle a request, replying in the encoding it was sent in.
+           Requests that fail are answered with the exception, so the
+           client raises it."""
+
+        if wire.is_wire(frame):
+            try:
+                cmd, args, kwargs = wire.decode_call(frame)
+                return wire.encode_ret(self._run(cmd, args, kwargs))
+            except Exception as e:
+                print(f"ERROR: request failed: {e!r}", file=sys.stderr)
+                return wire.encode_error(e)
+
+        try:
+            cmd = pickle.loads(frame)
+            assert isinstance(cmd, CMD), f"Received {type(cmd)}, expected {CMD}"
+
+            p = _decode(cmd.payload)
+            return pickle.dumps(CMD('ret', self._run(cmd.cmd, p['args'], p['kwargs'])))
+        except Exception as e:
+            print(f"ERROR: request failed: {e!r}", file=sys.stderr)
+            return pickle.dumps(CMD('error', (type(e).__name__, str(e))))
+
+    def _spawn(self, rep):
+        # called with _idle_lock held
+        self._idle += 1
+        threading.Thread(target=self._serve, args=(rep,), daemon=True).start()
+
+    def _serve(self, rep):
+        # each context handles one request at a time, independently of the
+        # others
+        ctx = rep.new_context()
+        try:
+            while True:
+                frame = ctx.recv()
+
+                with self._idle_lock:
+                    self._idle -= 1
+                    if self._idle < self.workers:
+                        self._spawn(rep)
+
+                ret = self._handle(frame)
+                ctx.send(ret)
+
+                if metrics.enabled:
+                    metrics.inc('kz_wire_bytes_total', len(frame) + len(ret), side='server')
+
+                with self._idle_lock:
+                    if self._idle >= self.workers:
+                        break
+
+                    self._idle += 1
+        except pynng.Closed:
+            pass
+        finally:
+            ctx.close()
 
     def run_proxy(self):
+        threading.Thread(target=self._dispatch_subs, daemon=True).start()
+
         with pynng.Rep0(listen=self.listen_addr) as rep:
+            with self._idle_lock:
+                for i in range(self.workers):
+                    self._spawn(rep)
+
             try:
                 while True:
-                    pcmd = rep.recv()
-                    cmd = pickle.loads(pcmd)
-                    if isinstance(cmd, CMD):
-                        ret = self._dispatch(cmd)
-                        assert ret is not None
-                        rep.send(pickle.dumps(ret))
-                    else:
-                        print(f"ERROR: received {type(cmd)}, expected {type(CMD)}")
+                    time.sleep(1)
             except KeyboardInterrupt:
                 print("Received CTRL+C, shutting down proxy")
 
+        self._writer.shutdown()
+
+
+
+class _RemoteBlob(io.RawIOBase):
+    """Reads a blob from the proxy in chunks"""
+
+    def __init__(self, ether, h):
+        self.ether = ether
+        self.hash = h
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.ether._call('blob_read', self.hash, self.pos, len(b))
+        n = len(data)
+        b[:n] = data
+        self.pos += n
+        return n
 
+class ProxyPostings(Postings):
+    """Postings kept by the proxy server. A thread long-polls the server
+       for updates to drop stale entries from the cache."""
+
+    # seconds before watching again after a failed call
+    retry = 1
+
+    def __init__(self, ether):
+        super().__init__()
+        self.ether = ether
+        self._stop = threading.Event()
+
+    def _refresh(self):
+        # called with self._lock held
+        if self._stamp is None:
+            ret = self.ether._call('postings_changes', None)
+            if ret is None:
+                return
+
+            self._stamp = ret[0]
+            threading.Thread(target=self._watch_changes, daemon=True).start()
+
+    def _watch_changes(self):
+        while not self._stop.is_set():
+            try:
+                ret = self.ether._call('postings_wait', self._stamp, POLL_TIMEOUT)
+            except pynng.Closed:
+                return
+            except Exception as e:
+                print(f"ERROR: watching postings failed: {e!r}", file=sys.stderr)
+                ret = None
+                self._stop.wait(self.retry)
+
+            with self._lock:
+                if ret is None:
+                    # the reply was lost, anything may have changed
+                    self._cache.clear()
+                    continue
+
+                self._stamp = ret[0]
+                self._invalidate(ret[1])
+
+    def _read(self, name):
+        ret = self.ether._call('posting_get', name)
+        return ret if ret is not None else (None, 0)
+
+    def put(self, name, value, type_ = None):
+        return self.ether._call('posting_put', name, value, type_)
+
+    def cas(self, name, value, version, type_ = None):
+        return self.ether._call('posting_cas', name, value, version, type_)
+
+    def watch(self, name, version = 0, timeout = 30):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            ret = self.ether._call('posting_watch', name, version, remaining)
+            if ret is None or ret[1] != version or remaining == 0:
+                return ret
 
 def check_ret(ret, src):
     if not isinstance(ret, CMD) or ret.cmd != 'ret':
@@ -68,60 +406,285 @@ def check_ret(ret, src):
 
     return True
 
+def _close_proxy(proxy, contexts, lock, stop):
+    # contexts must be closed before their socket, or pynng complains
+    # when they are garbage collected
+    stop.set()
+    with lock:
+        for ctx in contexts:
+            ctx.close()
+        contexts.clear()
+
+    proxy.close()
+
 class ProxyEther(Ether):
-    def __init__(self, dial_addr, *args, **kwargs):
+    """An ether that forwards to a proxy server.
+
+       protocol is 'wire' (the default) or 'pickle', which is needed to
+       talk to older proxy servers. recv then polls the server every
+       second, as older clients did.
+    """
+
+    def __init__(self, dial_addr, *args, protocol = 'wire', **kwargs):
         super().__init__(*args, **kwargs)
+        assert protocol in ('wire', 'pickle'), f"Unknown protocol {protocol}"
+        self.protocol = protocol
         self.proxy = pynng.Req0(dial=dial_addr)
+        self._local = threading.local()
+        self._contexts = []
+        self._contexts_lock = threading.Lock()
+        self.postings = ProxyPostings(self)
+        # also run at exit, for ethers that are never closed
+        self._closer = weakref.finalize(self, _close_proxy, self.proxy, self._contexts, self._contexts_lock,
+                                        self.postings._stop)
+
+    def _context(self):
+        # requests on a Req0 socket cancel each other, so each thread uses
+        # its own context
+        ctx = getattr(self._local, 'ctx', None)
+        if ctx is None:
+            ctx = self.proxy.new_context()
+            self._local.ctx = ctx
+            with self._contexts_lock:
+                self._contexts.append(ctx)
+
+        return ctx
+
+    def _call(self, cmd, *args, **kwargs):
+        """Call cmd on the proxy, raising the exception it failed with.
+           Returns None if the reply was malformed."""
+
+        start = time.perf_counter()
+        ctx = self._context()
+        if self.protocol == 'wire':
+            frame = wire.encode_call(cmd, *args, **kwargs)
+        else:
+            frame = _encode(cmd, *args, **kwargs)
 
-    def send(self, msg):
-        self.proxy.send(_encode('send', msg))
-        ret = pickle.loads(self.proxy.recv())
+        ctx.send(frame)
+        reply = ctx.recv()
 
-        msg.message_id = ret.payload
+        if metrics.enabled:
+            metrics.observe('kz_proxy_rpc_seconds', time.perf_counter() - start, cmd=cmd)
+            metrics.inc('kz_wire_bytes_total', len(frame) + len(reply), side='client')
 
-    def begin_trace(self, name, msg, duration):
-        self.proxy.send(_encode('begin_trace', name, msg, duration))
-        ret = pickle.loads(self.proxy.recv())
+        if self.protocol == 'wire':
+            try:
+                return wire.decode_ret(reply)
+            except wire.WireError as e:
+                print(f"ERROR: received malformed return value for {cmd}: {e}")
+                return None
+
+        ret = pickle.loads(reply)
+        if isinstance(ret, CMD) and ret.cmd == 'error':
+            raise wire.RemoteError(*ret.payload)
 
-        if not check_ret(ret, 'begin_trace'):
+        if not check_ret(ret, cmd):
             return None
 
-        msg.message_id = ret.payload[1]
-        return ret.payload[0]
+        return ret.payload
 
-    def end_trace(self, trace):
-        self.proxy.send(_encode('end_trace', trace))
-        ret = pickle.loads(self.proxy.recv())
-        if not check_ret(ret, 'end_trace'):
+    def _upload(self, att):
+        h = hashlib.sha256()
+        with att.open() as f:
+            while data := f.read(CHUNK_SIZE):
+                h.update(data)
+
+        if self._call('blob_exists', h.hexdigest()):
+            return (h.hexdigest(), att.size)
+
+        upload_id = self._call('blob_begin')
+        with att.open() as f:
+            while data := f.read(CHUNK_SIZE):
+                self._call('blob_write', upload_id, data)
+
+        return self._call('blob_commit', upload_id)
+
+    def _store_attachments(self, msgs):
+        # attachments are uploaded in chunks, so only their hashes travel
+        # with the message
+        for msg in msgs:
+            for att in msg.attachments:
+                if att.hash is None:
+                    att.hash, att.size = self._upload(att)
+
+    def _bind(self, msg):
+        if isinstance(msg, MessageHeader):
+            msg._ether = self
+
+        if not isinstance(msg, MessageHeader) or msg.attachments_loaded:
+            for att in msg.attachments:
+                att._store = self
+
+    def _headers(self, headers):
+        for h in headers:
+            self._bind(h)
+
+        return headers
+
+    def ancestors(self, message_id):
+        return self._headers(self._call('ancestors', message_id))
+
+    def descendants(self, message_id):
+        return self._headers(self._call('descendants', message_id))
+
+    def frontier(self, trace):
+        return self._headers(self._call('frontier', trace))
+
+    def trace_dag(self, trace):
+        headers, edges = self._call('trace_dag', trace)
+        return (self._headers(headers), edges)
+
+    def open(self, h):
+        return io.BufferedReader(_RemoteBlob(self, h), CHUNK_SIZE)
+
+    def send(self, msg):
+        self._store_attachments([msg])
+        msg.message_id = self._call('send', msg)
+
+    def send_many(self, msgs):
+        self._store_attachments(msgs)
+        ret = self._call('send_many', list(msgs))
+        if ret is None:
             return None
 
+        for msg, message_id in zip(msgs, ret):
+            msg.message_id = message_id
+
+    def begin_trace(self, name, msg, duration):
+        self._store_attachments([msg])
+        ret = self._call('begin_trace', name, msg, duration)
+        if ret is None:
+            return None
+
+        msg.trace = ret[0]
+        msg.message_id = ret[1]
+        return ret[0]
+
+    def end_trace(self, trace):
+        self._call('end_trace', trace)
         trace.active = False
 
-    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True):
-        start = datetime.datetime.utcnow()
+    def last_message_id(self):
+        return self._call('last_message_id')
+
+    def get_contents(self, message_ids):
+        return self._call('get_contents', list(message_ids)) or {}
+
+    def get_attachments(self, message_ids):
+        ret = self._call('get_attachments', list(message_ids)) or {}
+        for al in ret.values():
+            for att in al:
+                att._store = self
+
+        return ret
+
+    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False):
+        """Receive messages through a subscription on the proxy.
+
+           Each poll waits on the proxy until matching messages are
+           committed, so an idle recv costs one round trip every
+           POLL_TIMEOUT seconds. The cursor is kept here, so a
+           subscription lost when the proxy restarts resumes exactly.
+        """
+
+        after = self.last_message_id()
+        sub_id = None
         try:
             while True:
-                self.proxy.send(_encode('recv', channel, trace,
-                                        msg_types, sender_set=sender_set,
-                                        _start = start))
+                if sub_id is None:
+                    sub_id = self._call('subscribe', channel, trace, msg_types,
+                                        sender_set=sender_set,
+                                        headers_only=headers_only)
+                    if sub_id is None:
+                        if self.protocol == 'pickle':
+                            yield from self._recv_legacy(channel, trace, msg_types, sender_set, blocking)
+                            return
+
+                        raise RuntimeError("Proxy server does not support subscriptions, it may be older than this client")
+
+                ret = self._call('poll', sub_id, after, POLL_TIMEOUT if blocking else 0)
+                if ret is None:
+                    sub_id = None
+                    continue
+
+                for r in ret:
+                    self._bind(r)
+                    yield r
 
-                ret = pickle.loads(self.proxy.recv())
-                if not check_ret(ret, 'recv'):
-                    continue # ignore malformed messages
+                if len(ret):
+                    after = ret[-1].message_id
 
-                for r in ret.payload:
-                    yield r
+                if not blocking:
+                    break
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down recv loop")
+        finally:
+            if sub_id is not None:
+                self._call('unsubscribe', sub_id)
+
+    def _recv_legacy(self, channel, trace, msg_types, sender_set, blocking):
+        # servers from before subscriptions return the messages sent after
+        # a time. Messages sent in the same microsecond as the last one
+        # would be missed, so they are asked for again and skipped by id.
+        start = datetime.datetime.utcnow()
+        last_id = 0
+        try:
+            while True:
+                ret = self._call('recv', channel, trace, msg_types, sender_set=sender_set, _start=start) or []
+                for r in ret:
+                    if r.message_id > last_id:
+                        last_id = r.message_id
+                        yield r
 
-                if len(ret.payload):
-                    start = ret.payload[-1]._sent
+                if len(ret):
+                    start = s2dt(ret[-1]._sent) - datetime.timedelta(microseconds=1)
 
-                if blocking:
-                    time.sleep(1) # TODO: need to turn this into a notification instead of polling.
-                else:
+                if not blocking:
                     break
+
+                time.sleep(1)
         except KeyboardInterrupt:
             print("Detected CTRL+C, shutting down recv loop")
 
+    def close(self):
+        self._closer()
+        self._local = threading.local()
+
+    def claim(self, group, subscription, owner, lease = 60, limit = 1, max_attempts = None, headers_only = False, timeout = 0):
+        """Claim messages on the proxy, see Ether.claim"""
+
+        s = subscription
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            ret = self._call('claim', group, s.channel, s.trace, s.msg_types, s.sender_set, owner,
+                             lease=lease, limit=limit, max_attempts=max_attempts,
+                             headers_only=headers_only, timeout=remaining)
+            if ret is None:
+                return []
+
+            if len(ret) or remaining == 0:
+                return self._headers(ret)
+
+    def ack(self, group, owner, message_ids):
+        return self._call('ack', group, owner, list(message_ids))
+
+    def release(self, group, owner, message_ids):
+        self._call('release', group, owner, list(message_ids))
+
+    def extend_lease(self, group, owner, message_ids, lease):
+        return self._call('extend_lease', group, owner, list(message_ids), lease)
+
+    def memo_get(self, key, max_age = None):
+        return self._call('memo_get', key, max_age)
+
+    def memo_put(self, key, owner, value):
+        self._call('memo_put', key, owner, value)
+
+    def memo_evict(self, owner, max_bytes = None, max_age = None):
+        return self._call('memo_evict', owner, max_bytes, max_age)
+
 ProxyableEthers = {'sqlite': SQLiteProxyEther}
 
 def main():
@@ -131,10 +694,16 @@ def main():
     p = argparse.ArgumentParser(description='Start a Kaizen proxy server')
     p.add_argument('--kz-ether', help='Proxy to this ether', choices=ProxyableEthers.keys())
     p.add_argument('--kz-ether-args', help='Arguments for ether')
+    p.add_argument('--workers', type=int, default=8, help='Number of requests to handle concurrently')
+    p.add_argument('--metrics', metavar='DIR', help='Write metrics to DIR, see kz stats')
+    p.add_argument('--metrics-port', type=int, metavar='PORT', help='Serve metrics on http://127.0.0.1:PORT/')
     p.add_argument('listen_addr', nargs='?', default='tcp://127.0.0.1:43789/')
 
     args = p.parse_args()
 
+    if args.metrics or args.metrics_port:
+        metrics.enable(args.metrics, args.metrics_port, name='kz-proxy')
+
     if args.kz_ether is None:
         print("ERROR: --kz_ether required")
         sys.exit(1)
@@ -149,7 +718,7 @@ def main():
 
     print(f"Listening on {args.listen_addr} and proxying to {args.kz_ether}/{args.kz_ether_args}")
     print("Use CTRL+C or CTRL+\\ to quit")
-    srv = ProxyableEthers[args.kz_ether](listen_addr, db)
+    srv = ProxyableEthers[args.kz_ether](listen_addr, db, workers=args.workers)
     srv.run_proxy()
 
 if __name__ == "__main__":
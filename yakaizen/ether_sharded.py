@@ -0,0 +1,313 @@
+"""An ether that partitions messages across several SQLite databases.
+
+   Messages are placed by trace, so the messages of a trace, and hence
+   all lineage queries, stay in one shard. The database given to the
+   ether is a small catalog that allocates trace ids and records the
+   number of shards, the shards are kept next to it.
+"""
+
+import time
+import heapq
+
+from .core import Ether, MessageHeader, Subscription
+from .ether_sqlite import SQLiteEther, RetentionPolicy
+from .notify import wait_any
+from .wire import SourceRef
+
+DEFAULT_SHARDS = 4
+
+class ShardedSQLiteEther(Ether):
+    """Partitions messages across shards by trace id.
+
+       Message ids are unique across shards: a shard's local id i becomes
+       i * shards + shard. recv merges the shards' messages in id
+       order, which only follows send order within a shard. Sends to different shards use different databases, so
+       they do not contend for a write lock, but send_many is only
+       atomic per shard.
+    """
+
+    def __init__(self, database, *args, shards = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.catalog = SQLiteEther(database)
+        self.shards = self._setup_catalog(shards)
+        self.ethers = [SQLiteEther(f'{database}.shard-{i}', *args, **kwargs) for i in range(self.shards)]
+        self.poll_interval = self.ethers[0].poll_interval
+        self.postings = self.catalog.postings
+        self._next_shard = 0
+
+    def _setup_catalog(self, shards):
+        with self.catalog._get_conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS catalog (key TEXT PRIMARY KEY, value)')
+            row = conn.execute("SELECT value FROM catalog WHERE key = 'shards'").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO catalog (key, value) VALUES ('shards', ?)", (shards or DEFAULT_SHARDS,))
+                conn.commit()
+                return shards or DEFAULT_SHARDS
+
+        assert shards is None or shards == row[0], f"Database has {row[0]} shards, not {shards}"
+        return row[0]
+
+    def _shard(self, trace_id):
+        return trace_id % self.shards
+
+    def _global(self, shard, message_id):
+        return message_id * self.shards + shard
+
+    def _split(self, message_id):
+        """Return (shard, local id) of a message id"""
+        return (message_id % self.shards, message_id // self.shards)
+
+    def _globalize(self, shard, msgs):
+        for msg in msgs:
+            msg.message_id = self._global(shard, msg.message_id)
+            if isinstance(msg, MessageHeader):
+                msg._ether = self
+
+        return msgs
+
+    def _localize(self, msgs):
+        # the shard stores local ids of sources, the caller's messages are
+        # left untouched
+        saved = [m.sources_ for m in msgs]
+        for m in msgs:
+            m.sources_ = [SourceRef(self._split(s.message_id)[1], s.trace) for s in m.sources_]
+
+        return saved
+
+    def _send_shard(self, shard, msgs):
+        saved = self._localize(msgs)
+        try:
+            if len(msgs) == 1:
+                self.ethers[shard].send(msgs[0])
+            else:
+                self.ethers[shard].send_many(msgs)
+        finally:
+            for m, sources in zip(msgs, saved):
+                m.sources_ = sources
+
+        self._globalize(shard, msgs)
+
+    def send(self, msg):
+        assert msg.trace is not None, f"Use begin_trace to send a message that starts a trace"
+        self._send_shard(self._shard(msg.trace.trace_id), [msg])
+
+    def send_many(self, msgs):
+        by_shard = {}
+        for msg in msgs:
+            assert msg.trace is not None, f"Use begin_trace to send a message that starts a trace"
+            by_shard.setdefault(self._shard(msg.trace.trace_id), []).append(msg)
+
+        for shard, sm in by_shard.items():
+            self._send_shard(shard, sm)
+
+    def begin_trace(self, name, msg, duration):
+        assert msg.trace is None
+
+        # trace ids are allocated by the catalog, the shard holds a copy of
+        # the trace for its queries
+        with self.catalog._get_conn() as conn:
+            trace = self.catalog._insert_trace(conn, name, duration)
+            conn.commit()
+
+        shard = self._shard(trace.trace_id)
+        with self.ethers[shard]._get_conn() as conn:
+            conn.execute('INSERT INTO traces (id, name, start, expiry, active) VALUES (?,?,?,?,?)',
+                         (trace.trace_id, name, trace.start, trace.expiry, True))
+            conn.commit()
+
+        msg.trace = trace
+        self._send_shard(shard, [msg])
+        return trace
+
+    def end_trace(self, trace):
+        with self.catalog._get_conn() as conn:
+            conn.execute('UPDATE traces SET active = FALSE WHERE id = ?', (trace.trace_id,))
+            conn.commit()
+
+        self.ethers[self._shard(trace.trace_id)].end_trace(trace)
+
+    def expire_traces(self):
+        self.catalog.expire_traces()
+        for e in self.ethers:
+            e.expire_traces()
+
+    def last_message_id(self):
+        return max(self._global(i, e.last_message_id()) for i, e in enumerate(self.ethers))
+
+    def get_contents(self, message_ids):
+        out = {}
+        for shard, ids in self._group_ids(message_ids).items():
+            for local, contents in self.ethers[shard].get_contents(ids).items():
+                out[self._global(shard, local)] = contents
+
+        return out
+
+    def get_attachments(self, message_ids):
+        out = {}
+        for shard, ids in self._group_ids(message_ids).items():
+            for local, atts in self.ethers[shard].get_attachments(ids).items():
+                out[self._global(shard, local)] = atts
+
+        return out
+
+    def _group_ids(self, message_ids):
+        by_shard = {}
+        for message_id in message_ids:
+            shard, local = self._split(message_id)
+            by_shard.setdefault(shard, []).append(local)
+
+        return by_shard
+
+    def ancestors(self, message_id):
+        shard, local = self._split(message_id)
+        return self._globalize(shard, self.ethers[shard].ancestors(local))
+
+    def descendants(self, message_id):
+        shard, local = self._split(message_id)
+        return self._globalize(shard, self.ethers[shard].descendants(local))
+
+    def frontier(self, trace):
+        shard = self._shard(trace.trace_id)
+        return self._globalize(shard, self.ethers[shard].frontier(trace))
+
+    def trace_dag(self, trace):
+        shard = self._shard(trace.trace_id)
+        headers, edges = self.ethers[shard].trace_dag(trace)
+        return (self._globalize(shard, headers),
+                [(self._global(shard, s), self._global(shard, d)) for s, d in edges])
+
+    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False):
+        for sub, msg in self.recv_multi([Subscription(channel, trace, msg_types, sender_set)], blocking, headers_only):
+            yield msg
+
+    def recv_multi(self, subscriptions, blocking = True, headers_only = False):
+        """Yields (subscription, message) for every subscription a message
+           matches. A subscription to a trace only reads that trace's shard."""
+
+        subscriptions = list(subscriptions)
+        by_shard = {}
+        for sub in subscriptions:
+            shards = [self._shard(sub.trace.trace_id)] if sub.trace is not None else range(self.shards)
+            for shard in shards:
+                by_shard.setdefault(shard, []).append(sub)
+
+        listeners = []
+        if blocking:
+            for shard in by_shard:
+                n = self.ethers[shard]._notifier
+                listener = n.listen() if n else None
+                if listener is not None:
+                    listeners.append(listener)
+
+        cursors = {shard: self.ethers[shard].last_message_id() for shard in by_shard}
+        try:
+            while True:
+                polled = []
+                for shard, subs in by_shard.items():
+                    msgs = self.ethers[shard].wait_recv_multi(subs, after=cursors[shard], timeout=0,
+                                                              headers_only=headers_only)
+                    if len(msgs):
+                        cursors[shard] = msgs[-1].message_id
+                        polled.append(self._globalize(shard, msgs))
+
+                # each shard's messages are in id order, merge them by id
+                n = 0
+                for msg in heapq.merge(*polled, key=lambda m: m.message_id):
+                    n += 1
+                    for sub in subscriptions:
+                        if sub.matches(msg):
+                            yield (sub, msg)
+
+                if not blocking:
+                    break
+
+                if n == 0:
+                    # the poll interval is a fallback for writers on other hosts
+                    if len(listeners):
+                        wait_any(listeners, self.poll_interval)
+                    else:
+                        time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down recv loop")
+        finally:
+            for listener in listeners:
+                listener.close()
+
+    def claim(self, group, subscription, owner, lease = 60, limit = 1, max_attempts = None, headers_only = False, timeout = 0):
+        """Claim messages from the shards, starting at a different shard
+           each time so that none is starved"""
+
+        if subscription.trace is not None:
+            shards = [self._shard(subscription.trace.trace_id)]
+        else:
+            self._next_shard = (self._next_shard + 1) % self.shards
+            shards = [(self._next_shard + i) % self.shards for i in range(self.shards)]
+
+        deadline = time.monotonic() + timeout
+        listeners = []
+        if timeout > 0:
+            for shard in shards:
+                n = self.ethers[shard]._notifier
+                listener = n.listen() if n else None
+                if listener is not None:
+                    listeners.append(listener)
+
+        try:
+            while True:
+                msgs = []
+                for shard in shards:
+                    got = self.ethers[shard].claim(group, subscription, owner, lease, limit - len(msgs),
+                                                   max_attempts, headers_only)
+                    msgs.extend(self._globalize(shard, got))
+                    if len(msgs) >= limit:
+                        break
+
+                remaining = deadline - time.monotonic()
+                if len(msgs) or remaining <= 0:
+                    return msgs
+
+                if len(listeners):
+                    wait_any(listeners, min(remaining, self.poll_interval))
+                else:
+                    time.sleep(min(remaining, self.poll_interval))
+        finally:
+            for listener in listeners:
+                listener.close()
+
+    def ack(self, group, owner, message_ids):
+        return sum(self.ethers[shard].ack(group, owner, ids) for shard, ids in self._group_ids(message_ids).items())
+
+    def release(self, group, owner, message_ids):
+        for shard, ids in self._group_ids(message_ids).items():
+            self.ethers[shard].release(group, owner, ids)
+
+    def extend_lease(self, group, owner, message_ids, lease):
+        return sum(self.ethers[shard].extend_lease(group, owner, ids, lease) for shard, ids in self._group_ids(message_ids).items())
+
+    # memoized values are not tied to a trace, so they live in the catalog
+
+    def memo_get(self, key, max_age = None):
+        return self.catalog.memo_get(key, max_age)
+
+    def memo_put(self, key, owner, value):
+        self.catalog.memo_put(key, owner, value)
+
+    def memo_evict(self, owner, max_bytes = None, max_age = None):
+        return self.catalog.memo_evict(owner, max_bytes, max_age)
+
+    def compact(self, policy):
+        """Apply a RetentionPolicy to every shard, archives are sharded too"""
+
+        removed = 0
+        for i, e in enumerate(self.ethers):
+            archive = f'{policy.archive}.shard-{i}' if policy.archive is not None else None
+            removed += e.compact(RetentionPolicy(policy.keep, archive, policy.batch_size, policy.vacuum_pages))
+
+        self.catalog.expire_traces()
+        return removed
+
+    def close(self):
+        for e in self.ethers:
+            e.close()
+
+        self.catalog.close()
@@ -0,0 +1,378 @@
+"""An ether for workflows whose agents all run on one host.
+
+   Messages are delivered through a ring buffer in shared memory and
+   written to the SQLite database in batches by a background thread, so
+   persistence is off the critical path.
+"""
+
+import os
+import sys
+import mmap
+import time
+import queue
+import fcntl
+import atexit
+import struct
+import hashlib
+import datetime
+import threading
+
+from .core import Ether, Subscription
+from .ether_sqlite import SQLiteEther
+from .notify import Notifier
+from . import wire
+
+RING_SIZE = 64 * 1024 * 1024
+
+MAGIC = b'KZRING01'
+
+# magic, capacity, write position, next message id, reserved position
+_HEADER = struct.Struct('<8sQQQQ')
+_U64 = struct.Struct('<Q')
+WRITE_POS = 16
+NEXT_ID = 24
+RESERVE_POS = 32
+DATA = 64
+
+# payload length, message id (0 for control records)
+_RECORD = struct.Struct('<IQ')
+PAD = 0xFFFFFFFF
+
+def ring_path(database):
+    """Return the path of the ring buffer of a database, in /dev/shm if possible"""
+
+    database = os.path.abspath(str(database))
+    h = hashlib.sha256(database.encode('utf-8')).hexdigest()[:16]
+    d = '/dev/shm' if os.path.isdir('/dev/shm') else os.path.dirname(database)
+    return os.path.join(d, f'kz-ring-{h}')
+
+def _aligned(n):
+    return (n + 7) & ~7
+
+class Ring:
+    """A ring buffer of records in a file mapped by every process of a host.
+
+       Writers serialize on a lock file. Readers take no locks, instead a
+       writer first reserves the space it will overwrite, so a reader can
+       tell whether a record changed while it was being read.
+    """
+
+    def __init__(self, path, capacity, next_id):
+        self.path = path
+        self._tlock = threading.Lock() # flock does not exclude threads
+        self._lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+
+        with self:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                new = os.fstat(fd).st_size == 0
+                if new:
+                    os.ftruncate(fd, DATA + capacity)
+
+                self.mm = mmap.mmap(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+
+            if new:
+                _HEADER.pack_into(self.mm, 0, MAGIC, capacity, 0, next_id, 0)
+
+            magic, self.capacity, _, cur_id, _ = _HEADER.unpack_from(self.mm, 0)
+            assert magic == MAGIC, f"{path} is not a ring buffer"
+
+            # the database may have been written to without the ring
+            if next_id > cur_id:
+                _U64.pack_into(self.mm, NEXT_ID, next_id)
+
+    def __enter__(self):
+        self._tlock.acquire()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        self._tlock.release()
+
+    def _get(self, offset):
+        return _U64.unpack_from(self.mm, offset)[0]
+
+    def write_pos(self):
+        return self._get(WRITE_POS)
+
+    def append(self, payloads, control = False):
+        """Append records, returning the message ids assigned to them"""
+
+        cap = self.capacity
+        with self:
+            start = pos = self._get(WRITE_POS)
+            next_id = self._get(NEXT_ID)
+
+            # lay the records out first, so that the space is reserved
+            # before it is overwritten
+            layout = []
+            for p in payloads:
+                need = _aligned(_RECORD.size + len(p))
+                assert need <= cap, f"Record of {len(p)} bytes does not fit in the ring, use attachments for large data"
+
+                if cap - pos % cap < need:
+                    layout.append((pos, None))
+                    pos += cap - pos % cap
+
+                layout.append((pos, p))
+                pos += need
+
+            _U64.pack_into(self.mm, RESERVE_POS, pos)
+
+            ids = []
+            for rpos, p in layout:
+                off = DATA + rpos % cap
+                if p is None:
+                    if cap - rpos % cap >= _RECORD.size:
+                        _RECORD.pack_into(self.mm, off, PAD, 0)
+                    continue
+
+                mid = 0 if control else next_id
+                _RECORD.pack_into(self.mm, off, len(p), mid)
+                self.mm[off + _RECORD.size:off + _RECORD.size + len(p)] = p
+                if not control:
+                    ids.append(next_id)
+                    next_id += 1
+
+            _U64.pack_into(self.mm, NEXT_ID, next_id)
+            _U64.pack_into(self.mm, WRITE_POS, pos)
+
+        return ids
+
+    def read(self, pos):
+        """Return (records, pos, lost). records is a list of (id, payload)
+           written since pos, lost is True if the writers overtook the
+           reader, in which case pos skips to the write position."""
+
+        cap = self.capacity
+        end = self.write_pos()
+        records = []
+        while pos < end:
+            off = pos % cap
+            if cap - off < _RECORD.size:
+                pos += cap - off
+                continue
+
+            n, mid = _RECORD.unpack_from(self.mm, DATA + off)
+            if self._get(RESERVE_POS) - cap > pos:
+                return (records, self.write_pos(), True)
+
+            if n == PAD:
+                pos += cap - off
+                continue
+
+            payload = self.mm[DATA + off + _RECORD.size:DATA + off + _RECORD.size + n]
+            if self._get(RESERVE_POS) - cap > pos:
+                return (records, self.write_pos(), True)
+
+            records.append((mid, payload))
+            pos += _aligned(_RECORD.size + n)
+
+        return (records, pos, False)
+
+    def close(self):
+        self.mm.close()
+        os.close(self._lock_fd)
+
+class SharedMemoryEther(Ether):
+    """Delivers messages between the processes of a host through a ring
+       buffer in shared memory, persisting them to the SQLite database
+       asynchronously in batches.
+
+       The ring assigns message ids, so every writer to the database must
+       use this ether. Messages that were not yet persisted are lost if
+       their sender dies. Readers that fall behind by more than the size
+       of the ring skip ahead, the skipped messages are in the database.
+    """
+
+    def __init__(self, database, *args, ring_size = RING_SIZE, batch_size = 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ethsq = SQLiteEther(database, *args, **kwargs)
+        self.poll_interval = self.ethsq.poll_interval
+        self.postings = self.ethsq.postings
+        self.batch_size = batch_size
+
+        path = ring_path(database)
+        self.ring = Ring(path, ring_size, self.ethsq.last_message_id() + 1)
+        self._notifier = Notifier(path) if Notifier.supported() else None
+
+        self._queue = queue.Queue()
+        threading.Thread(target=self._persist_loop, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _persist_loop(self):
+        while True:
+            batch = self._queue.get()
+            n = 1
+
+            # everything sent while the last batch was written goes into
+            # the next one
+            while len(batch) < self.batch_size:
+                try:
+                    batch = batch + self._queue.get_nowait()
+                    n += 1
+                except queue.Empty:
+                    break
+
+            try:
+                self.ethsq.persist(batch)
+            except Exception as e:
+                print(f"ERROR: persisting {len(batch)} messages failed: {e!r}", file=sys.stderr)
+            finally:
+                for i in range(n):
+                    self._queue.task_done()
+
+    def flush(self):
+        """Wait until the messages sent by this process are in the database"""
+        self._queue.join()
+
+    def _publish(self, msgs):
+        sent = datetime.datetime.utcnow()
+        ids = self.ring.append([wire.encode_value(m) for m in msgs])
+        for msg, message_id in zip(msgs, ids):
+            msg.message_id = message_id
+            msg._sent = sent
+
+        if self._notifier is not None:
+            self._notifier.signal()
+
+        self._queue.put(list(msgs))
+
+    def send(self, msg):
+        self.send_many([msg])
+
+    def send_many(self, msgs):
+        for msg in msgs:
+            assert msg.message_id is None, f"Can't resend message"
+            assert msg.trace is not None, f"Use begin_trace to send a message that starts a trace"
+            self.ethsq._check_send(msg)
+
+        if len(msgs) == 0:
+            return
+
+        self.ethsq._store_attachments(msgs)
+        self._publish(msgs)
+
+    def begin_trace(self, name, msg, duration):
+        assert msg.trace is None
+
+        # traces are rare, so they are created in the database directly
+        with self.ethsq._get_conn() as conn:
+            msg.trace = self.ethsq._insert_trace(conn, name, duration)
+            conn.commit()
+
+        self.ethsq._store_attachments([msg])
+        self._publish([msg])
+        return msg.trace
+
+    def end_trace(self, trace):
+        self.ethsq.end_trace(trace)
+
+        # tell readers to drop messages of the trace still in the ring
+        self.ring.append([wire.encode_value(('end_trace', trace.trace_id))], control=True)
+        if self._notifier is not None:
+            self._notifier.signal()
+
+    def last_message_id(self):
+        return self.ring._get(NEXT_ID) - 1
+
+    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False):
+        """Receive messages sent after recv is called. Messages always carry
+           their contents, headers_only is accepted for compatibility."""
+
+        for sub, msg in self.recv_multi([Subscription(channel, trace, msg_types, sender_set)], blocking):
+            yield msg
+
+    def recv_multi(self, subscriptions, blocking = True, headers_only = False):
+        """Yields (subscription, message) for every subscription a message matches"""
+
+        subscriptions = list(subscriptions)
+        ended = set()
+
+        # listen before reading so that a send in between is not missed
+        listener = self._notifier.listen() if blocking and self._notifier else None
+        pos = self.ring.write_pos()
+        try:
+            while True:
+                records, pos, lost = self.ring.read(pos)
+                if lost:
+                    print(f"WARNING: recv fell behind the ring buffer, skipped messages are only in the database", file=sys.stderr)
+
+                now = datetime.datetime.utcnow()
+                for message_id, payload in records:
+                    value = wire.decode_value(payload)
+                    if message_id == 0:
+                        if value[0] == 'end_trace':
+                            ended.add(value[1])
+                        continue
+
+                    msg = value
+                    if msg.trace.trace_id in ended or not msg.trace.active or msg.trace.expiry <= now:
+                        continue
+
+                    msg.message_id = message_id
+                    for att in msg.attachments:
+                        att._store = self.ethsq.blobs
+
+                    for sub in subscriptions:
+                        if sub.matches(msg):
+                            yield (sub, msg)
+
+                if not blocking:
+                    break
+
+                if len(records) == 0:
+                    if listener is not None:
+                        listener.wait(self.poll_interval)
+                    else:
+                        time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print("Detected CTRL+C, shutting down recv loop")
+        finally:
+            if listener is not None:
+                listener.close()
+
+    # lineage and lazy loads are answered by the database, after this
+    # process's messages are persisted
+
+    def get_contents(self, message_ids):
+        self.flush()
+        return self.ethsq.get_contents(message_ids)
+
+    def get_attachments(self, message_ids):
+        self.flush()
+        return self.ethsq.get_attachments(message_ids)
+
+    def ancestors(self, message_id):
+        self.flush()
+        return self.ethsq.ancestors(message_id)
+
+    def descendants(self, message_id):
+        self.flush()
+        return self.ethsq.descendants(message_id)
+
+    def frontier(self, trace):
+        self.flush()
+        return self.ethsq.frontier(trace)
+
+    def trace_dag(self, trace):
+        self.flush()
+        return self.ethsq.trace_dag(trace)
+
+    def memo_get(self, key, max_age = None):
+        return self.ethsq.memo_get(key, max_age)
+
+    def memo_put(self, key, owner, value):
+        self.ethsq.memo_put(key, owner, value)
+
+    def memo_evict(self, owner, max_bytes = None, max_age = None):
+        return self.ethsq.memo_evict(owner, max_bytes, max_age)
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+        self.ring.close()
+        self.ethsq.close()
@@ -1,18 +1,224 @@
-from .core import Ether, Trace, AsyncMessage
+from .core import Ether, Trace, AsyncMessage, MessageHeader, Subscription, Postings, ATTACHMENT_KINDS
+from .notify import Notifier
+from .blobs import BlobStore
+from . import wire
+from . import metrics
 import sqlite3
 import datetime
 import time
+import threading
+import json
+import os
+import queue
+import sys
+import urllib.parse
+
+MMAP_SIZE = 256 * 1024 * 1024
+
+# unreferenced blobs younger than this (in seconds) are not deleted, since
+# a sender may be about to reference them
+BLOB_GRACE = 3600
+
+INSERT_MESSAGE = 'INSERT INTO messages (channel, type, sender, contents, has_attachments, sent, trace_id, starts_trace) VALUES (?,?,?,?,?,?,?,?)'
+
+# for messages whose ids were assigned outside the database
+INSERT_MESSAGE_ID = 'INSERT INTO messages (id, channel, type, sender, contents, has_attachments, sent, trace_id, starts_trace) VALUES (?,?,?,?,?,?,?,?,?)'
+
+HEADER_COLUMNS = 'messages.id, messages.channel, messages.type, messages.sender, messages.has_attachments, messages.sent, messages.trace_id, LENGTH(messages.contents) AS size, traces.name, traces.start, traces.expiry, traces.active'
+
+# upper bound of the recv cursor when none is given
+MAX_ID = 2**63 - 1
+
+INSERT_ATTACHMENT = 'INSERT INTO attachments (message_id, type, kind, hash, size) VALUES (?,?,?,?,?)'
+
+class RetentionPolicy:
+    """Messages of inactive traces that expired more than `keep` ago are
+       deleted, or moved to the `archive` database if one is given."""
+
+    def __init__(self, keep = datetime.timedelta(days=7), archive = None, batch_size = 1000, vacuum_pages = 1000):
+        self.keep = keep
+        self.archive = archive
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
 
 def s2dt(s):
     return datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
 
+class SQLitePostings(Postings):
+    """Postings stored in the postings table.
+
+       Versions are drawn from one counter shared by all postings, so
+       the cache is checked by looking for versions above the highest
+       one seen. Writers on this host wake up caches through a
+       notifier, writes from other hosts are noticed within the ether's
+       poll_interval.
+    """
+
+    def __init__(self, ether):
+        super().__init__()
+        self.ether = ether
+        self._notifier = Notifier(str(ether.database) + '.kz-postings') if ether._notifier is not None else None
+        self._listener = None
+        self._checked = 0
+
+    def _signal(self):
+        if self._notifier is not None:
+            self._notifier.signal()
+
+    def changes(self, stamp):
+        """Return (stamp, names) where names are the postings updated after
+           stamp, and stamp is the highest version seen"""
+
+        with self.ether._get_conn() as conn:
+            if stamp is None:
+                return (conn.execute('SELECT COALESCE(MAX(version), 0) FROM postings').fetchone()[0], [])
+
+            rows = conn.execute('SELECT name, version FROM postings WHERE version > ?', (stamp,)).fetchall()
+
+        return (max([stamp] + [r[1] for r in rows]), [r[0] for r in rows])
+
+    def wait_changes(self, stamp, timeout):
+        """Like changes, but wait up to timeout seconds for an update"""
+
+        deadline = time.monotonic() + timeout
+        listener = self._notifier.listen() if timeout > 0 and self._notifier else None
+        try:
+            while True:
+                stamp, names = self.changes(stamp)
+                remaining = deadline - time.monotonic()
+                if len(names) or remaining <= 0:
+                    return (stamp, names)
+
+                if listener is not None:
+                    listener.wait(min(remaining, self.ether.poll_interval))
+                else:
+                    time.sleep(min(remaining, self.ether.poll_interval))
+        finally:
+            if listener is not None:
+                listener.close()
+
+    def _refresh(self):
+        # called with self._lock held
+        if self._stamp is None:
+            if self._notifier is not None:
+                self._listener = self._notifier.listen()
+
+            self._stamp = self.changes(None)[0]
+            self._checked = time.monotonic()
+            return
+
+        woken = self._listener.wait(0) if self._listener is not None else True
+        if woken or time.monotonic() - self._checked > self.ether.poll_interval:
+            self._stamp, names = self.changes(self._stamp)
+            self._invalidate(names)
+            self._checked = time.monotonic()
+
+    def _read(self, name):
+        with self.ether._get_conn() as conn:
+            row = conn.execute('SELECT contents, version FROM postings WHERE name = ?', (name,)).fetchone()
+
+        if row is None:
+            return (None, 0)
+
+        return (wire.decode_value(row[0]), row[1])
+
+    def _write(self, name, value, version, type_):
+        """Set a posting, if version is not None only if its version matches"""
+
+        contents = wire.encode_value(value)
+        next_version = '(SELECT COALESCE(MAX(version), 0) + 1 FROM postings)'
+        with self.ether._get_conn() as conn:
+            if version is None:
+                cur = conn.execute(f'INSERT INTO postings (name, type, contents, version) VALUES (?, ?, ?, {next_version}) ON CONFLICT(name) DO UPDATE SET type = excluded.type, contents = excluded.contents, version = excluded.version',
+                                   (name, type_, contents))
+            elif version == 0:
+                cur = conn.execute(f'INSERT INTO postings (name, type, contents, version) VALUES (?, ?, ?, {next_version}) ON CONFLICT(name) DO NOTHING',
+                                   (name, type_, contents))
+            else:
+                cur = conn.execute(f'UPDATE postings SET type = ?, contents = ?, version = {next_version} WHERE name = ? AND version = ?',
+                                   (type_, contents, name, version))
+
+            if cur.rowcount == 0:
+                conn.rollback()
+                return None
+
+            new_version = conn.execute('SELECT version FROM postings WHERE name = ?', (name,)).fetchone()[0]
+            conn.commit()
+
+        self._signal()
+        return new_version
+
+    def put(self, name, value, type_ = None):
+        return self._write(name, value, None, type_)
+
+    def cas(self, name, value, version, type_ = None):
+        return self._write(name, value, version, type_)
+
+    def watch(self, name, version = 0, timeout = 30):
+        deadline = time.monotonic() + timeout
+        listener = self._notifier.listen() if timeout > 0 and self._notifier else None
+        try:
+            while True:
+                value, v = self._read(name)
+                remaining = deadline - time.monotonic()
+                if v != version or remaining <= 0:
+                    return (value, v)
+
+                if listener is not None:
+                    listener.wait(min(remaining, self.ether.poll_interval))
+                else:
+                    time.sleep(min(remaining, self.ether.poll_interval))
+        finally:
+            if listener is not None:
+                listener.close()
+
+class _PendingSend:
+    def __init__(self, msgs):
+        self.msgs = msgs
+        self.done = threading.Event()
+        self.error = None
+
 class SQLiteEther(Ether):
-    """A ether running on top of a SQLite database"""
+    """A ether running on top of a SQLite database.
+
+       With group_commit, sends from all threads are committed together by
+       one thread. Sends that arrive while a batch is being committed,
+       or within commit_window seconds of the first, go into the next
+       batch, up to commit_batch messages. send still returns only once
+       its messages are committed.
 
-    def __init__(self, database, *args, **kwargs):
+       synchronous is SQLite's setting. NORMAL commits may be lost on a
+       power failure, FULL makes every commit durable at the cost of an
+       fsync, which group_commit shares among the sends of a batch.
+
+       With readonly, an existing database is opened for queries only,
+       and neither it nor its blob store is created or migrated.
+    """
+
+    def __init__(self, database, *args, notify = True, poll_interval = 1.0,
+                 group_commit = False, commit_window = 0, commit_batch = 256,
+                 synchronous = 'NORMAL', readonly = False, **kwargs):
         super().__init__(*args, **kwargs)
         self.database = database
-        self._setup_database()
+        self.readonly = readonly
+        self.poll_interval = poll_interval
+        self.group_commit = group_commit
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+        assert synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA'), f"Unknown synchronous mode {synchronous}"
+        self.synchronous = synchronous
+        self._notifier = Notifier(database) if notify and Notifier.supported() else None
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self.blobs = BlobStore(str(database) + '.kz-blobs', create=not readonly)
+        if not readonly:
+            self._setup_database()
+        self.postings = SQLitePostings(self)
+
+        if group_commit:
+            self._commits = queue.Queue()
+            threading.Thread(target=self._commit_loop, daemon=True).start()
 
     def _setup_database(self):
         setup_sql = """
@@ -20,74 +226,337 @@ CREATE TABLE IF NOT EXISTS channels (id INTEGER PRIMARY KEY, name TEXT NOT NULL)
 
 CREATE TABLE IF NOT EXISTS traces (id INTEGER PRIMARY KEY, start DATETIME NOT NULL, expiry DATETIME, active BOOLEAN, name TEXT NOT NULL);
 
+CREATE INDEX IF NOT EXISTS traces_active_expiry ON traces(active, expiry);
+
 CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, channel TEXT NOT NULL, type TEXT NOT NULL, sender TEXT NOT NULL, contents TEXT, has_attachments BOOLEAN, sent DATETIME NOT NULL, trace_id INTEGER NOT NULL, starts_trace BOOLEAN NOT NULL, FOREIGN KEY(trace_id) REFERENCES traces(id));
 
 CREATE INDEX IF NOT EXISTS messages_sent ON messages(sent);
 
+CREATE INDEX IF NOT EXISTS messages_channel_type_id ON messages(channel, type, id);
+
+CREATE INDEX IF NOT EXISTS messages_trace_id ON messages(trace_id, id);
+
 CREATE TABLE IF NOT EXISTS message_sources (msg_id INTEGER, src_msg_id INTEGER, FOREIGN KEY(msg_id) REFERENCES messages(id), FOREIGN KEY(src_msg_id) REFERENCES messages(id));
 
-CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY, message_id INTEGER, type TEXT NOT NULL, contents BLOB, FOREIGN KEY(message_id) REFERENCES messages(id));
+CREATE INDEX IF NOT EXISTS message_sources_msg_id ON message_sources(msg_id, src_msg_id);
+
+CREATE INDEX IF NOT EXISTS message_sources_src_msg_id ON message_sources(src_msg_id, msg_id);
+
+CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY, message_id INTEGER, type TEXT NOT NULL, contents BLOB, kind TEXT, hash TEXT, size INTEGER, FOREIGN KEY(message_id) REFERENCES messages(id));
 
 CREATE TABLE IF NOT EXISTS postings (id INTEGER PRIMARY KEY, name TEXT UNIQUE, type TEXT, contents BLOB);
+
+CREATE TABLE IF NOT EXISTS work_groups (name TEXT PRIMARY KEY, cursor INTEGER NOT NULL);
+
+CREATE TABLE IF NOT EXISTS claims (grp TEXT NOT NULL, msg_id INTEGER NOT NULL, owner TEXT NOT NULL, lease_until REAL NOT NULL, attempts INTEGER NOT NULL, PRIMARY KEY (grp, msg_id)) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS claims_lease ON claims(grp, lease_until);
+
+CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, owner TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, used REAL NOT NULL) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS memo_used ON memo(owner, used);
 """
         with self._get_conn() as conn:
             conn.executescript(setup_sql)
+            self._migrate(conn)
             conn.commit()
 
-    def _get_conn(self):
-        conn = sqlite3.connect(self.database, autocommit=False)
+    def _add_column(self, conn, table, column, decl):
+        cols = set(r['name'] for r in conn.execute(f'PRAGMA table_info({table})'))
+        if column not in cols:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+    def _migrate(self, conn):
+        # databases created before attachments were implemented
+        self._add_column(conn, 'attachments', 'kind', 'TEXT')
+        self._add_column(conn, 'attachments', 'hash', 'TEXT')
+        self._add_column(conn, 'attachments', 'size', 'INTEGER')
+
+        conn.execute('CREATE INDEX IF NOT EXISTS attachments_message_id ON attachments(message_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS attachments_hash ON attachments(hash)')
+
+        # versions of postings, for compare-and-swap and cache invalidation
+        self._add_column(conn, 'postings', 'version', 'INTEGER NOT NULL DEFAULT 0')
+        conn.execute('CREATE INDEX IF NOT EXISTS postings_version ON postings(version)')
+
+        # the frontier holds the active messages of each trace, i.e. those
+        # not used as a source by any other message
+        has_frontier = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'frontier'").fetchone()
+        if not has_frontier:
+            conn.execute('CREATE TABLE frontier (trace_id INTEGER NOT NULL, msg_id INTEGER NOT NULL, PRIMARY KEY (trace_id, msg_id)) WITHOUT ROWID')
+            conn.execute('INSERT INTO frontier SELECT trace_id, id FROM messages WHERE NOT EXISTS (SELECT 1 FROM message_sources WHERE src_msg_id = messages.id)')
+
+    def _connect(self):
+        # pragmas must run outside a transaction, so connect in autocommit
+        # mode first. Connections are only ever used by the thread that
+        # created them, check_same_thread is off so close() can run anywhere.
+        if self.readonly:
+            conn = sqlite3.connect(f'file:{urllib.parse.quote(str(self.database))}?mode=ro', uri=True,
+                                   autocommit=True, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(self.database, autocommit=True,
+                                   check_same_thread=False, cached_statements=256)
+            # only takes effect on new databases, needed for incremental_vacuum
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        conn.autocommit = False
         conn.row_factory = sqlite3.Row
         return conn
 
-    def _send(self, conn, msg):
+    def _get_conn(self):
+        """Return this thread's connection, creating it if necessary.
+
+           Use as `with self._get_conn() as conn:` so that the transaction
+           (and the read snapshot) ends when the block does.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+
+        return conn
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+
+        self._local = threading.local()
+
+        if self._notifier is not None:
+            self._notifier.close()
+
+    def _notify(self):
+        if self._notifier is not None:
+            self._notifier.signal()
+
+    def _check_send(self, msg):
         assert msg.type_ is not None
         assert msg.sender is not None
         assert msg.trace is not None
 
-        if len(msg.sources) > 0:
-            raise NotImplementedError
+        for src in msg.sources:
+            assert src.message_id is not None, f"Sources must be sent before they are used"
+            assert src.trace.trace_id == msg.trace.trace_id, f"Sources must be in the same trace"
+
+    def _message_values(self, msg, sent = None):
+        return (msg.channel.name, msg.type_, msg.sender, msg.contents,
+                len(msg.attachments) > 0,
+                sent or datetime.datetime.utcnow(),
+                msg.trace.trace_id, False)
+
+    def _store_attachments(self, msgs):
+        # blobs are written before the transaction starts so that large
+        # attachments do not hold the write lock
+        for msg in msgs:
+            for att in msg.attachments:
+                if att.hash is None:
+                    with att.open() as f:
+                        att.hash, att.size = self.blobs.put(f)
+                else:
+                    # uploaded through the proxy
+                    assert self.blobs.exists(att.hash), f"Attachment blob {att.hash} not found"
+
+                att._store = self.blobs
+
+    def _insert_attachments(self, conn, msgs):
+        values = []
+        for msg in msgs:
+            for att in msg.attachments:
+                values.append((msg.message_id, att.type_, att.__class__.__name__,
+                               att.hash, att.size))
+
+        if len(values):
+            conn.executemany(INSERT_ATTACHMENT, values)
+
+    def _insert_sources(self, conn, msgs):
+        conn.executemany('INSERT INTO message_sources (msg_id, src_msg_id) VALUES (?,?)',
+                         [(m.message_id, src.message_id) for m in msgs for src in m.sources])
+        conn.executemany('DELETE FROM frontier WHERE trace_id = ? AND msg_id = ?',
+                         [(src.trace.trace_id, src.message_id) for m in msgs for src in m.sources])
+        # messages may be inserted after messages that use them as sources
+        # when they are persisted out of order
+        conn.executemany('INSERT INTO frontier (trace_id, msg_id) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM message_sources WHERE src_msg_id = ?)',
+                         [(m.trace.trace_id, m.message_id, m.message_id) for m in msgs])
 
-        if len(msg.attachments) > 0:
-            raise NotImplementedError
+    def _send(self, conn, msg):
+        self._check_send(msg)
 
         cur = conn.cursor()
-        cur.execute('INSERT INTO messages (channel, type, sender, contents, has_attachments, sent, trace_id, starts_trace) VALUES (?,?,?,?,?,?,?,?)',
-                    (msg.channel.name, msg.type_, msg.sender, msg.contents,
-                     len(msg.attachments) > 0,
-                     datetime.datetime.utcnow(),
-                     msg.trace.trace_id, False))
+        cur.execute(INSERT_MESSAGE, self._message_values(msg))
 
         msg.message_id = cur.lastrowid
         cur.close()
 
+        self._insert_sources(conn, [msg])
+        self._insert_attachments(conn, [msg])
+
+    def _send_many(self, conn, msgs):
+        for msg in msgs:
+            self._check_send(msg)
+
+        cur = conn.cursor()
+        cur.executemany(INSERT_MESSAGE, [self._message_values(m) for m in msgs])
+        last = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        cur.close()
+
+        # the write lock is held for the whole executemany, and new rowids
+        # are always one more than the current maximum, so the batch
+        # received consecutive ids
+        for i, msg in enumerate(msgs):
+            msg.message_id = last - len(msgs) + 1 + i
+
+        self._insert_sources(conn, msgs)
+        self._insert_attachments(conn, msgs)
+
+    def _commit_loop(self):
+        while True:
+            batch = [self._commits.get()]
+            n = len(batch[0].msgs)
+            deadline = time.monotonic() + self.commit_window
+            while n < self.commit_batch:
+                # sends queued while the last batch was committed are
+                # taken without waiting
+                remaining = deadline - time.monotonic()
+                try:
+                    p = self._commits.get(timeout=remaining) if remaining > 0 else self._commits.get_nowait()
+                except queue.Empty:
+                    break
+
+                batch.append(p)
+                n += len(p.msgs)
+
+            try:
+                with self._get_conn() as conn:
+                    self._send_many(conn, [m for p in batch for m in p.msgs])
+                    self._commit(conn)
+            except Exception:
+                # retry the sends one by one so that a bad send does not
+                # fail the others
+                for p in batch:
+                    for m in p.msgs:
+                        m.message_id = None
+
+                    try:
+                        with self._get_conn() as conn:
+                            self._send_many(conn, p.msgs)
+                            self._commit(conn)
+                    except Exception as e:
+                        p.error = e
+
+            self._notify()
+            for p in batch:
+                p.done.set()
+
+    def _commit(self, conn):
+        start = time.perf_counter()
+        conn.commit()
+        metrics.observe('kz_commit_seconds', time.perf_counter() - start, ether='sqlite')
+
+    def _sent(self, msgs, start):
+        if metrics.enabled:
+            metrics.observe('kz_send_seconds', time.perf_counter() - start, ether='sqlite')
+            metrics.inc('kz_messages_sent_total', len(msgs), ether='sqlite')
+
+    def _group_send(self, msgs):
+        # checked here so that the error is raised in the sender
+        for msg in msgs:
+            self._check_send(msg)
+
+        p = _PendingSend(msgs)
+        self._commits.put(p)
+        p.done.wait()
+        if p.error is not None:
+            raise p.error
+
     def send(self, msg):
         assert msg.message_id is None, f"Can't resend message"
         assert msg.trace is not None, f"Use begin_trace to send a message that starts a trace"
 
+        start = time.perf_counter()
+        self._store_attachments([msg])
+
+        if self.group_commit:
+            self._group_send([msg])
+            self._sent([msg], start)
+            return
+
         with self._get_conn() as conn:
             self._send(conn, msg)
-            conn.commit()
+            self._commit(conn)
 
-    def begin_trace(self, name, msg, duration):
-        assert msg.trace is None
+        self._notify()
+        self._sent([msg], start)
+
+    def send_many(self, msgs):
+        """Send several messages in a single transaction"""
+
+        for msg in msgs:
+            assert msg.message_id is None, f"Can't resend message"
+            assert msg.trace is not None, f"Use begin_trace to send a message that starts a trace"
+
+        if len(msgs) == 0:
+            return
+
+        start = time.perf_counter()
+        self._store_attachments(msgs)
+
+        if self.group_commit:
+            self._group_send(msgs)
+            self._sent(msgs, start)
+            return
+
+        with self._get_conn() as conn:
+            self._send_many(conn, msgs)
+            self._commit(conn)
+
+        self._notify()
+        self._sent(msgs, start)
+
+    def _insert_trace(self, conn, name, duration):
+        self._expire_traces(conn)
 
         start = datetime.datetime.utcnow()
-        expiry = start + duration
+        cur = conn.cursor()
+        cur.execute('INSERT INTO traces (name, start, expiry, active) VALUES (?,?,?,?)',
+                    (name, start, start + duration, True))
+
+        trace_id = cur.lastrowid
+        cur.close()
+
+        return Trace(name, trace_id, start, duration, True)
+
+    def persist(self, msgs):
+        """Insert messages whose ids and send times (msg._sent) were assigned
+           elsewhere, e.g. by SharedMemoryEther. Their attachments must
+           already be stored."""
 
         with self._get_conn() as conn:
-            cur = conn.cursor()
-            cur.execute('INSERT INTO traces (name, start, expiry, active) VALUES (?,?,?,?)',
-                        (name, start, expiry, True))
+            conn.executemany(INSERT_MESSAGE_ID, [(m.message_id,) + self._message_values(m, m._sent) for m in msgs])
+            self._insert_sources(conn, msgs)
+            self._insert_attachments(conn, msgs)
+            conn.commit()
 
-            trace_id = cur.lastrowid
-            cur.close()
+        self._notify()
+
+    def begin_trace(self, name, msg, duration):
+        assert msg.trace is None
 
-            msg.trace = Trace(name, trace_id, start, duration, True)
+        self._store_attachments([msg])
+
+        with self._get_conn() as conn:
+            msg.trace = self._insert_trace(conn, name, duration)
             self._send(conn, msg)
 
             conn.commit()
 
-            return msg.trace
+        self._notify()
+        return msg.trace
 
     def end_trace(self, trace):
         assert trace.trace_id is not None
@@ -101,93 +570,498 @@ CREATE TABLE IF NOT EXISTS postings (id INTEGER PRIMARY KEY, name TEXT UNIQUE, t
 
         trace.active = False
 
-    # TODO: recv header to only get headers of messages retrieving bodies and attachments later
-    # TODO: support NOT IN
-    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, _start = None):
-        traces_cache = {}
+    def _expire_traces(self, conn):
+        conn.execute('UPDATE traces SET active = FALSE WHERE active = TRUE AND expiry <= ?',
+                     (datetime.datetime.utcnow(),))
+
+    def expire_traces(self):
+        """Deactivate traces that have expired"""
+        with self._get_conn() as conn:
+            self._expire_traces(conn)
+
+    def _archive_batch(self, conn, ids, trace_ids):
+        conn.execute('INSERT OR IGNORE INTO archive.traces SELECT * FROM traces WHERE id IN (SELECT value FROM json_each(?))', (trace_ids,))
+        conn.execute('INSERT OR IGNORE INTO archive.messages SELECT * FROM messages WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+        conn.execute('INSERT INTO archive.message_sources SELECT * FROM message_sources WHERE msg_id IN (SELECT value FROM json_each(?))', (ids,))
+        conn.execute('INSERT OR IGNORE INTO archive.attachments SELECT * FROM attachments WHERE message_id IN (SELECT value FROM json_each(?))', (ids,))
+
+    def _archive_blob(self, archive_blobs, h):
+        dst = archive_blobs.blob_path(h)
+        if os.path.exists(dst) or not self.blobs.exists(h):
+            return
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        try:
+            os.link(self.blobs.blob_path(h), dst)
+        except OSError:
+            with self.blobs.open(h) as f:
+                archive_blobs.put(f)
+
+    def compact(self, policy):
+        """Apply a RetentionPolicy, returning the number of messages removed.
+
+           Messages are removed in batches of policy.batch_size, each in its
+           own short transaction, so senders are never blocked for long.
+        """
+
+        self.expire_traces()
+        cutoff = datetime.datetime.utcnow() - policy.keep
+        archive_blobs = None
+
+        conn = self._connect()
+        try:
+            if policy.archive is not None:
+                # creates the archive's schema
+                SQLiteEther(policy.archive, notify=False).close()
+                archive_blobs = BlobStore(str(policy.archive) + '.kz-blobs')
+
+                conn.autocommit = True
+                conn.execute('ATTACH DATABASE ? AS archive', (str(policy.archive),))
+                conn.autocommit = False
+
+            removed = 0
+            hashes = set()
+            while True:
+                with conn:
+                    # never remove the newest message, its id would be reused
+                    # and recv cursors would skip the next message
+                    rows = conn.execute('SELECT messages.id, messages.trace_id FROM traces, messages WHERE traces.active = FALSE AND traces.expiry < ? AND messages.trace_id = traces.id AND messages.id < (SELECT MAX(id) FROM messages) LIMIT ?',
+                                        (cutoff, policy.batch_size)).fetchall()
+                    if len(rows) == 0:
+                        break
+
+                    ids = json.dumps([r[0] for r in rows])
+                    trace_ids = json.dumps(list(set(r[1] for r in rows)))
 
-        def build_in_set(x):
-            return "(" + ','.join(["'" + xx + "'" for xx in x]) + ")"
+                    batch_hashes = [r[0] for r in conn.execute('SELECT DISTINCT hash FROM attachments WHERE message_id IN (SELECT value FROM json_each(?))', (ids,))]
+                    hashes.update(batch_hashes)
 
-        def get_trace(conn, trace_id):
-            if trace_id not in traces_cache:
-                cur = conn.cursor()
-                res = cur.execute('SELECT * FROM traces WHERE id = ?', (trace_id,))
-                row = cur.fetchone()
-                assert row is not None
-                cur.close()
+                    if policy.archive is not None:
+                        self._archive_batch(conn, ids, trace_ids)
+                        for h in batch_hashes:
+                            self._archive_blob(archive_blobs, h)
 
-                start = s2dt(row['start'])
-                expiry = s2dt(row['expiry'])
+                    conn.execute('DELETE FROM claims WHERE msg_id IN (SELECT value FROM json_each(?))', (ids,))
+                    conn.execute('DELETE FROM message_sources WHERE msg_id IN (SELECT value FROM json_each(?))', (ids,))
+                    conn.execute('DELETE FROM attachments WHERE message_id IN (SELECT value FROM json_each(?))', (ids,))
+                    conn.execute('DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))', (ids,))
 
-                trace = Trace(row['id'], start, expiry - start, row['active'])
-                traces_cache[trace_id] = trace
+                removed += len(rows)
 
-            return traces_cache[trace_id]
+            with conn:
+                conn.execute('DELETE FROM frontier WHERE trace_id IN (SELECT id FROM traces WHERE active = FALSE AND expiry < ? AND NOT EXISTS (SELECT 1 FROM messages WHERE trace_id = traces.id))', (cutoff,))
+                conn.execute('DELETE FROM traces WHERE active = FALSE AND expiry < ? AND NOT EXISTS (SELECT 1 FROM messages WHERE trace_id = traces.id)', (cutoff,))
 
-        def get_trace_2(row):
-            trace_id = row['trace_id']
-            if trace_id not in traces_cache:
-                start = s2dt(row['start'])
-                expiry = s2dt(row['expiry'])
+            for h in hashes:
+                with conn:
+                    referenced = conn.execute('SELECT 1 FROM attachments WHERE hash = ? LIMIT 1', (h,)).fetchone()
 
-                trace = Trace(row['name'], row['trace_id'], start, expiry - start, row['active'])
-                traces_cache[trace_id] = trace
+                if not referenced:
+                    self.blobs.delete(h, grace=BLOB_GRACE)
 
-            return traces_cache[trace_id]
+            with conn:
+                conn.execute(f'PRAGMA incremental_vacuum({int(policy.vacuum_pages)})').fetchall()
 
-        def convert(conn, row):
-            trace = get_trace_2(row)
+            return removed
+        finally:
+            conn.close()
+
+    def start_retention(self, policy, interval = 60):
+        """Run compact(policy) every interval seconds in a background thread"""
+
+        def loop():
+            while True:
+                self.compact(policy)
+                time.sleep(interval)
+
+        t = threading.Thread(target=loop, daemon=True, name='kz-retention')
+        t.start()
+        return t
+
+    def last_message_id(self):
+        """Return the id of the most recent message, usable as a recv cursor."""
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT MAX(id) FROM messages').fetchone()
+
+        return row[0] or 0
+
+    def get_trace(self, trace_id):
+        """Return the trace with id trace_id, or None"""
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT id AS trace_id, name, start, expiry, active FROM traces WHERE id = ?', (trace_id,)).fetchone()
+
+        return self._row_trace(row, {}) if row is not None else None
+
+    def _row_trace(self, row, traces_cache):
+        trace_id = row['trace_id']
+        if trace_id not in traces_cache:
+            start = s2dt(row['start'])
+            expiry = s2dt(row['expiry'])
+
+            trace = Trace(row['name'], row['trace_id'], start, expiry - start, row['active'])
+            traces_cache[trace_id] = trace
+
+        return traces_cache[trace_id]
+
+    def _row_message(self, row, traces_cache, headers_only):
+        trace = self._row_trace(row, traces_cache)
+        if headers_only:
+            msg = MessageHeader(self, row['channel'], row['type'], row['sender'],
+                                row['size'], row['has_attachments'], trace)
+        else:
             msg = AsyncMessage(row['channel'], row['type'], row['sender'],
                                row['contents'], [], trace)
-            msg._sent = row['sent']
-            msg.message_id = row['id']
+        msg._sent = row['sent']
+        msg._has_attachments = row['has_attachments']
+        msg.message_id = row['id']
+
+        return msg
+
+    def get_contents(self, message_ids):
+        with self._get_conn() as conn:
+            rows = conn.execute('SELECT id, contents FROM messages WHERE id IN (SELECT value FROM json_each(?))',
+                                (json.dumps(list(message_ids)),)).fetchall()
+
+        return dict((r['id'], r['contents']) for r in rows)
+
+    def _get_attachments(self, conn, message_ids):
+        out = dict((mid, []) for mid in message_ids)
+        if len(out) == 0:
+            return out
+
+        rows = conn.execute('SELECT * FROM attachments WHERE message_id IN (SELECT value FROM json_each(?)) ORDER BY id',
+                            (json.dumps(list(message_ids)),)).fetchall()
+
+        for r in rows:
+            att = ATTACHMENT_KINDS.get(r['kind'], ATTACHMENT_KINDS['Attachment'])(None, r['type'], None)
+            att.hash = r['hash']
+            att.size = r['size']
+            att._store = self.blobs
+            out[r['message_id']].append(att)
+
+        return out
+
+    def get_attachments(self, message_ids):
+        with self._get_conn() as conn:
+            return self._get_attachments(conn, message_ids)
+
+    def _query_headers(self, conn, sql, params):
+        traces_cache = {}
+        return [self._row_message(row, traces_cache, True) for row in conn.execute(sql, params)]
+
+    def ancestors(self, message_id):
+        """Return headers of all messages message_id is derived from"""
+        with self._get_conn() as conn:
+            return self._query_headers(conn, f'''WITH RECURSIVE anc(id) AS
+  (SELECT src_msg_id FROM message_sources WHERE msg_id = ?
+   UNION SELECT s.src_msg_id FROM message_sources s, anc WHERE s.msg_id = anc.id)
+SELECT {HEADER_COLUMNS} FROM messages, traces WHERE messages.trace_id = traces.id AND messages.id IN anc ORDER BY messages.id''', (message_id,))
+
+    def descendants(self, message_id):
+        """Return headers of all messages derived from message_id"""
+        with self._get_conn() as conn:
+            return self._query_headers(conn, f'''WITH RECURSIVE desc_(id) AS
+  (SELECT msg_id FROM message_sources WHERE src_msg_id = ?
+   UNION SELECT s.msg_id FROM message_sources s, desc_ WHERE s.src_msg_id = desc_.id)
+SELECT {HEADER_COLUMNS} FROM messages, traces WHERE messages.trace_id = traces.id AND messages.id IN desc_ ORDER BY messages.id''', (message_id,))
+
+    def frontier(self, trace):
+        """Return headers of the active messages of trace, i.e. those that are not a source of any message"""
+        with self._get_conn() as conn:
+            return self._query_headers(conn, f'SELECT {HEADER_COLUMNS} FROM frontier, messages, traces WHERE frontier.trace_id = ? AND messages.id = frontier.msg_id AND traces.id = frontier.trace_id ORDER BY messages.id',
+                                       (trace.trace_id,))
+
+    def trace_dag(self, trace):
+        """Return (headers, edges) for trace, where edges are (src_msg_id, msg_id) pairs"""
+        with self._get_conn() as conn:
+            headers = self._query_headers(conn, f'SELECT {HEADER_COLUMNS} FROM messages, traces WHERE messages.trace_id = ? AND traces.id = messages.trace_id ORDER BY messages.id',
+                                          (trace.trace_id,))
+            edges = [(r[0], r[1]) for r in conn.execute('SELECT s.src_msg_id, s.msg_id FROM messages m, message_sources s WHERE m.trace_id = ? AND s.msg_id = m.id ORDER BY s.msg_id',
+                                                         (trace.trace_id,))]
+
+        return (headers, edges)
+
+    # TODO: support NOT IN
+    def _sub_constraints(self, i, sub, values):
+        # sets are passed as JSON arrays so the query text only depends on
+        # which constraints are present and sqlite3 can reuse the statement
+        values[f'channel{i}'] = sub.channel.name
+        constraints = [f'messages.channel = :channel{i}']
+
+        if sub.trace is not None:
+            assert sub.trace.trace_id is not None
+            values[f'trace{i}'] = sub.trace.trace_id
+            constraints.append(f'messages.trace_id = :trace{i}')
+
+        if sub.msg_types is not None:
+            values[f'msg_types{i}'] = json.dumps(list(sub.msg_types))
+            constraints.append(f'messages.type IN (SELECT value FROM json_each(:msg_types{i}))')
+
+        if sub.sender_set is not None:
+            values[f'sender_set{i}'] = json.dumps(list(sub.sender_set))
+            constraints.append(f'messages.sender IN (SELECT value FROM json_each(:sender_set{i}))')
+
+        return '(' + ' AND '.join(constraints) + ')'
+
+    def _recv_query(self, subscriptions, headers_only, columns = None, limit = False):
+        """Return a query for the messages matching any of the subscriptions,
+           between the cursors :after and :upto, and at most :limit of them
+           if limit is True"""
+
+        values = {'upto': MAX_ID}
+        matches = ' OR '.join(self._sub_constraints(i, sub, values) for i, sub in enumerate(subscriptions))
+
+        # message ids are monotonic, unlike sent, so the last id seen is an
+        # exact cursor
+        if columns is None:
+            columns = HEADER_COLUMNS if headers_only else '*'
+
+        limit = ' LIMIT :limit' if limit else ''
+
+        query = f'SELECT {columns} FROM messages, traces WHERE messages.trace_id = traces.id AND traces.active = TRUE AND traces.expiry > :now AND messages.id > :after AND messages.id <= :upto AND ({matches}) ORDER BY messages.id{limit};'
+        return (query, values)
+
+    def _poll(self, query, values, headers_only, traces_cache):
+        start = time.perf_counter()
+        values['now'] = datetime.datetime.utcnow()
+        with self._get_conn() as conn:
+            cur = conn.cursor()
+            res = cur.execute(query, values)
+            rows = list([self._row_message(row, traces_cache, headers_only) for row in res.fetchall()])
+            cur.close()
+
+            if not headers_only:
+                atts = self._get_attachments(conn, [m.message_id for m in rows if m._has_attachments])
+                for msg in rows:
+                    for att in atts.get(msg.message_id, []):
+                        att.message = msg
+                        msg.attach(att)
+
+        if metrics.enabled:
+            metrics.observe('kz_recv_query_seconds', time.perf_counter() - start, ether='sqlite')
+            metrics.observe('kz_recv_rows', len(rows), ether='sqlite')
+            if len(rows) == 0:
+                metrics.inc('kz_idle_polls_total', ether='sqlite')
+
+        return rows
+
+    def wait_recv(self, channel, trace, msg_types, sender_set = None, after = 0, timeout = 30, headers_only = False):
+        """Return the messages after the cursor `after`, waiting up to
+           timeout seconds for at least one to arrive."""
+
+        return self.wait_recv_multi([Subscription(channel, trace, msg_types, sender_set)],
+                                    after=after, timeout=timeout, headers_only=headers_only)
 
-            return msg
+    def wait_recv_multi(self, subscriptions, after = 0, upto = None, timeout = 30, headers_only = False):
+        """Return the messages matching any of the subscriptions after the
+           cursor `after` and up to `upto`, waiting up to timeout seconds
+           for at least one to arrive."""
 
-        values = {'channel': channel.name}
+        query, values = self._recv_query(subscriptions, headers_only)
+        values['after'] = after
+        if upto is not None:
+            values['upto'] = upto
 
-        constraints = []
+        deadline = time.monotonic() + timeout
 
-        if trace is not None:
-            assert trace.trace_id is not None
-            values['trace'] = trace.trace_id
-            constraints.append('trace_id = :trace')
+        listener = self._notifier.listen() if timeout > 0 and self._notifier else None
+        try:
+            while True:
+                rows = self._poll(query, values, headers_only, {})
+                remaining = deadline - time.monotonic()
+                if len(rows) > 0 or remaining <= 0:
+                    return rows
+
+                if listener is not None:
+                    listener.wait(min(remaining, self.poll_interval))
+                else:
+                    time.sleep(min(remaining, self.poll_interval))
+        finally:
+            if listener is not None:
+                listener.close()
 
-        if msg_types is not None:
-            values['msg_types'] = msg_types
-            constraints.append(f'type IN {build_in_set(msg_types)}')
+    def recv(self, channel, trace, msg_types, sender_set = None, blocking = True, headers_only = False, _after = None):
+        """Receive messages, if headers_only is True, yield MessageHeader
+           objects whose contents and attachments are fetched on demand."""
 
-        if sender_set is not None:
-            values['sender_set'] = sender_set
-            constraints.append(f'sender IN {build_in_set(sender_set)}')
+        yield from self._recv([Subscription(channel, trace, msg_types, sender_set)],
+                              blocking, headers_only, _after)
 
-        query = 'SELECT * FROM messages, traces WHERE messages.trace_id = traces.id AND traces.active = TRUE AND messages.sent > :start AND ' + ' AND '.join(constraints) + ' ORDER BY messages.sent;'
-        cur = None
+    def recv_multi(self, subscriptions, blocking = True, headers_only = False, _after = None):
+        """Receive the messages of several subscriptions with one query per
+           wake-up. Yields (subscription, message) for every subscription
+           a message matches."""
 
+        subscriptions = list(subscriptions)
+        for msg in self._recv(subscriptions, blocking, headers_only, _after):
+            for sub in subscriptions:
+                if sub.matches(msg):
+                    yield (sub, msg)
+
+    def _recv(self, subscriptions, blocking, headers_only, _after):
+        traces_cache = {}
+        query, values = self._recv_query(subscriptions, headers_only)
         #TODO: possibly make this the oldest active trace?
-        values['start'] = _start or datetime.datetime.utcnow()
+        values['after'] = _after if _after is not None else self.last_message_id()
+
+        # listen before the first query so that a send between a query and
+        # the subsequent wait is not missed
+        listener = self._notifier.listen() if blocking and self._notifier else None
         try:
             while True:
-                rows = []
-                with self._get_conn() as conn:
-                    cur = conn.cursor()
-                    res = cur.execute(query, values)
-                    rows = list([convert(conn, row) for row in res.fetchall()])
-                    cur.close()
+                rows = self._poll(query, values, headers_only, traces_cache)
 
                 if len(rows) > 0:
                     for msg in rows:
                         yield msg
 
-                    # race conditions here ...
-                    values['start'] = rows[-1]._sent
+                    values['after'] = rows[-1].message_id
 
-                if blocking:
-                    time.sleep(1) # TODO: need to turn this into a notification instead of polling.
-                else:
+                if not blocking:
                     break
+
+                if len(rows) == 0:
+                    # the poll interval is a fallback for writers on other hosts
+                    if listener is not None:
+                        listener.wait(self.poll_interval)
+                    else:
+                        time.sleep(self.poll_interval)
         except KeyboardInterrupt:
             print("Detected CTRL+C, shutting down recv loop")
+        finally:
+            if listener is not None:
+                listener.close()
+
+
+
+    def _claim_ids(self, group, subscription, owner, lease, limit, max_attempts):
+        now = time.time()
+        query, values = self._recv_query([subscription], True, columns='messages.id', limit=True)
+        values['now'] = datetime.datetime.utcnow()
+
+        with self._get_conn() as conn:
+            # write first, so the claim holds the write lock throughout and
+            # owners never see the same unclaimed message
+            conn.execute('INSERT INTO work_groups (name, cursor) VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM messages)) ON CONFLICT(name) DO NOTHING', (group,))
+
+            expired = conn.execute('SELECT claims.msg_id, claims.attempts, traces.active AND traces.expiry > ? AS live FROM claims, messages, traces WHERE claims.grp = ? AND claims.lease_until < ? AND claims.msg_id = messages.id AND messages.trace_id = traces.id ORDER BY claims.msg_id LIMIT ?',
+                                   (values['now'], group, now, limit)).fetchall()
+
+            retry = []
+            dropped = []
+            for r in expired:
+                if not r['live']:
+                    dropped.append(r['msg_id'])
+                elif max_attempts is not None and r['attempts'] >= max_attempts:
+                    print(f"WARNING: giving up on message {r['msg_id']} in {group} after {r['attempts']} attempts", file=sys.stderr)
+                    dropped.append(r['msg_id'])
+                else:
+                    retry.append(r['msg_id'])
+
+            if len(expired):
+                conn.execute('DELETE FROM claims WHERE grp = ? AND msg_id IN (SELECT value FROM json_each(?))', (group, json.dumps(dropped)))
+                conn.execute('UPDATE claims SET owner = ?, lease_until = ?, attempts = attempts + 1 WHERE grp = ? AND msg_id IN (SELECT value FROM json_each(?))',
+                             (owner, now + lease, group, json.dumps(retry)))
+
+            new = []
+            if len(retry) < limit:
+                values['after'] = conn.execute('SELECT cursor FROM work_groups WHERE name = ?', (group,)).fetchone()[0]
+                values['limit'] = limit - len(retry)
+                new = [r[0] for r in conn.execute(query, values)]
+                if len(new):
+                    conn.executemany('INSERT INTO claims (grp, msg_id, owner, lease_until, attempts) VALUES (?, ?, ?, ?, 1)',
+                                     [(group, m, owner, now + lease) for m in new])
+                    conn.execute('UPDATE work_groups SET cursor = ? WHERE name = ?', (new[-1], group))
+
+            conn.commit()
+
+        return retry + new
+
+    def claim(self, group, subscription, owner, lease = 60, limit = 1, max_attempts = None, headers_only = False, timeout = 0):
+        """Claim messages for owner, see Ether.claim. Expired leases are
+           noticed within poll_interval."""
 
+        deadline = time.monotonic() + timeout
+        listener = self._notifier.listen() if timeout > 0 and self._notifier else None
+        try:
+            while True:
+                ids = self._claim_ids(group, subscription, owner, lease, limit, max_attempts)
+                remaining = deadline - time.monotonic()
+                if len(ids) or remaining <= 0:
+                    break
+
+                if listener is not None:
+                    listener.wait(min(remaining, self.poll_interval))
+                else:
+                    time.sleep(min(remaining, self.poll_interval))
+        finally:
+            if listener is not None:
+                listener.close()
+
+        if len(ids) == 0:
+            return []
+
+        columns = HEADER_COLUMNS if headers_only else '*'
+        query = f'SELECT {columns} FROM messages, traces WHERE messages.trace_id = traces.id AND messages.id IN (SELECT value FROM json_each(:ids)) ORDER BY messages.id'
+        return self._poll(query, {'ids': json.dumps(ids)}, headers_only, {})
+
+    def ack(self, group, owner, message_ids):
+        with self._get_conn() as conn:
+            n = conn.execute('DELETE FROM claims WHERE grp = ? AND owner = ? AND msg_id IN (SELECT value FROM json_each(?))',
+                             (group, owner, json.dumps(list(message_ids)))).rowcount
+            conn.commit()
+
+        return n
+
+    def release(self, group, owner, message_ids):
+        with self._get_conn() as conn:
+            conn.execute('UPDATE claims SET lease_until = 0 WHERE grp = ? AND owner = ? AND msg_id IN (SELECT value FROM json_each(?))',
+                         (group, owner, json.dumps(list(message_ids))))
+            conn.commit()
+
+        self._notify()
+
+    def extend_lease(self, group, owner, message_ids, lease):
+        with self._get_conn() as conn:
+            n = conn.execute('UPDATE claims SET lease_until = ? WHERE grp = ? AND owner = ? AND msg_id IN (SELECT value FROM json_each(?))',
+                             (time.time() + lease, group, owner, json.dumps(list(message_ids)))).rowcount
+            conn.commit()
+
+        return n
+
+    # entries used again within this many seconds keep their last use
+    # time, so that most hits do not write
+    MEMO_USE_RESOLUTION = 60
+
+    def memo_get(self, key, max_age = None):
+        now = time.time()
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT value, created, used FROM memo WHERE key = ?', (key,)).fetchone()
+            if row is None or (max_age is not None and row['created'] < now - max_age):
+                return None
+
+            if row['used'] < now - self.MEMO_USE_RESOLUTION:
+                conn.execute('UPDATE memo SET used = ? WHERE key = ?', (now, key))
+                conn.commit()
+
+        return row['value']
+
+    def memo_put(self, key, owner, value):
+        now = time.time()
+        with self._get_conn() as conn:
+            conn.execute('INSERT INTO memo (key, owner, value, size, created, used) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, value = excluded.value, size = excluded.size, created = excluded.created, used = excluded.used',
+                         (key, owner, value, len(value), now, now))
+            conn.commit()
+
+    def memo_evict(self, owner, max_bytes = None, max_age = None):
+        with self._get_conn() as conn:
+            n = 0
+            if max_age is not None:
+                n += conn.execute('DELETE FROM memo WHERE owner = ? AND created < ?', (owner, time.time() - max_age)).rowcount
+
+            if max_bytes is not None:
+                n += conn.execute('DELETE FROM memo WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS total FROM memo WHERE owner = ?) WHERE total > ?)',
+                                  (owner, max_bytes)).rowcount
+            conn.commit()
 
+        return n
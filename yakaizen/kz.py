@@ -5,6 +5,11 @@ import configparser
 import shutil
 import shlex
 import subprocess
+import datetime
+import time
+import importlib
+
+from yakaizen.ether_sqlite import SQLiteEther, RetentionPolicy
 
 def start_proxies(config):
     hosts = config.get('proxy', 'hosts', fallback='')
@@ -29,7 +34,23 @@ def start_proxies(config):
 
     return processes
 
-def start_agent(agent, config, args):
+def start_dispatcher(config, args):
+    """Start a proxy that agents on this host share, so that the database
+       sees one reader instead of one per agent"""
+
+    if config.get('workflow-config', 'ether') != 'sqlite' or args.kz_ether_arg is None:
+        print("ERROR: --dispatcher requires the sqlite ether and --kz-ether-arg")
+        return None
+
+    cmdline = ['kz-proxy', '--kz-ether', 'sqlite', '--kz-ether-args', args.kz_ether_arg, args.dispatcher]
+    try:
+        print("Running ", shlex.join(cmdline))
+        return subprocess.Popen(cmdline, close_fds = True)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return None
+
+def start_agent(agent, config, args, ether = None, work_queue = False):
     print(f"Starting {agent}")
 
     agent_section = f'agent:{agent}'
@@ -49,12 +70,18 @@ def start_agent(agent, config, args):
 
     if not is_complete:
         # construct standard command line
-        ether = config['workflow-config']['ether']
-        kz_ether_arg = args.kz_ether_arg
+        if ether is None:
+            ether = config['workflow-config']['ether']
+            kz_ether_arg = args.kz_ether_arg
+        else:
+            kz_ether_arg = args.dispatcher
 
         cmdline = [cmd, '--kz-ether', ether]
         if kz_ether_arg is not None:
             cmdline.extend(['--kz-ether-arg', kz_ether_arg])
+
+        if work_queue:
+            cmdline.append('--kz-work-queue')
     else:
         cmdline = shlex.split(cmd)
 
@@ -120,17 +147,26 @@ def do_run_agent(args):
         agents = agents.intersection(set(args.agent))
 
     processes = []
-    for a in agents:
-        p = start_agent(a, cfg, args)
+    if args.dispatcher:
+        p = start_dispatcher(cfg, args)
         if not p:
-            print(f"ERROR: Failed to start agent {a}. Terminating other agents started.")
-            for (ag, other_p) in processes:
-                print(f"Terminating {ag}")
-                other_p.terminate()
-
             return
-        else:
-            processes.append((a, p))
+
+        processes.append(('dispatcher', p))
+
+    for a in agents:
+        for i in range(args.replicas):
+            p = start_agent(a, cfg, args, ether='proxy' if args.dispatcher else None,
+                            work_queue=args.replicas > 1)
+            if not p:
+                print(f"ERROR: Failed to start agent {a}. Terminating other agents started.")
+                for (ag, other_p) in processes:
+                    print(f"Terminating {ag}")
+                    other_p.terminate()
+
+                return
+            else:
+                processes.append((a, p))
 
     print("Waiting")
     for a, p in processes:
@@ -149,6 +185,42 @@ def do_run_agent(args):
             break
 
 
+def get_retention_policy(cfg):
+    sect = 'ether:sqlite'
+    days = cfg.getfloat(sect, 'retention_days', fallback=7)
+    archive = cfg.get(sect, 'archive', fallback=None)
+    batch_size = cfg.getint(sect, 'batch_size', fallback=1000)
+
+    return RetentionPolicy(keep=datetime.timedelta(days=days), archive=archive,
+                           batch_size=batch_size)
+
+def do_compact(args):
+    cfg = load_config(args.config)
+
+    if cfg.get('workflow-config', 'ether', fallback=None) != 'sqlite':
+        print(f"ERROR: compact is only supported for the sqlite ether")
+        sys.exit(1)
+
+    if args.kz_ether_arg is None:
+        print(f"ERROR: compact requires the database as --kz-ether-arg")
+        sys.exit(1)
+
+    policy = get_retention_policy(cfg)
+    ether = SQLiteEther(args.kz_ether_arg)
+
+    try:
+        while True:
+            removed = ether.compact(policy)
+            print(f"Removed {removed} messages")
+            if args.loop is None:
+                break
+
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        print("Detected CTRL+C, stopping")
+    finally:
+        ether.close()
+
 def load_config(config):
     if not config.exists():
         print(f"ERROR: {config} does not exist")
@@ -176,8 +248,18 @@ def do_create_config(args):
     with open(args.config, "w") as f:
         cfg.write(f)
 
+# commands that do not use a configuration file, run as `kz <tool> ...`
+TOOLS = {'bench': 'yakaizen.bench',
+         'stats': 'yakaizen.metrics',
+         'profile-trace': 'yakaizen.profile'}
+
 def main():
-    p = argparse.ArgumentParser(description="Run Kaizen workflows")
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        importlib.import_module(TOOLS[sys.argv[1]]).main(sys.argv[2:])
+        return
+
+    p = argparse.ArgumentParser(description="Run Kaizen workflows",
+                                epilog=f"Other commands: {', '.join(TOOLS)}, run `kz <command> --help`")
 
     p.add_argument("config", help="Config file", type=Path)
 
@@ -186,16 +268,22 @@ def main():
     cc = sp.add_parser('create-config', help="Create a configuration file")
 
     cc.add_argument("workflow_name", help="Workflow name")
-    cc.add_argument("ether", help="Ether provider", choices=['sqlite'])
+    cc.add_argument("ether", help="Ether provider", choices=['sqlite', 'shm', 'sharded'])
     cc.add_argument("workflow_agent", help="Workflow agent")
     cc.add_argument("--agent", action="append", help="Agent to include in workflow", default=[])
 
     ra = sp.add_parser('run-agent', help="Run an agent")
     ra.add_argument("agent", nargs="+", help="Agents to run, 'all' for all agents in config")
     ra.add_argument("--kz-ether-arg", help="--kz-ether-arg to pass to agent")
+    ra.add_argument("--dispatcher", metavar="ADDR", help="Start a proxy on ADDR (e.g. ipc:///tmp/kz.ipc) and connect the agents to it")
+    ra.add_argument("--replicas", type=int, default=1, metavar="N", help="Start N copies of each agent that share its messages (--kz-work-queue)")
 
     spro = sp.add_parser("start-proxies")
 
+    co = sp.add_parser('compact', help="Apply the retention policy in [ether:sqlite] to the database")
+    co.add_argument("--kz-ether-arg", help="Database file")
+    co.add_argument("--loop", type=float, metavar="SECONDS", help="Compact every SECONDS seconds until interrupted")
+
     rw = sp.add_parser('run-workflow', help="Run the workflow agent from a config")
     rw.add_argument("args", nargs='+', help='Arguments to pass to workflow agent')
 
@@ -207,6 +295,8 @@ def main():
         do_run_agent(args)
     elif args.cmd == "start-proxies":
         do_start_proxies(args)
+    elif args.cmd == "compact":
+        do_compact(args)
     else:
         print(f"ERROR: Not implemented {args.cmd}")
 
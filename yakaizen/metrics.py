@@ -0,0 +1,318 @@
+"""Counters and histograms for ethers and agents.
+
+   Metrics are off unless enable() is called, e.g. by agents started with
+   --kz-metrics, or by setting KZ_METRICS_DIR. They are exported in the
+   Prometheus text format, to a file per process and/or over HTTP, and
+   `kz stats` sums the files of all processes.
+"""
+
+import os
+import re
+import sys
+import time
+import bisect
+import atexit
+import threading
+
+# seconds
+SECONDS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2,
+           2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# rows, bytes, etc.
+COUNTS = [4 ** i for i in range(11)]
+
+# name: (type, help, buckets)
+METRICS = {
+    'kz_send_seconds': ('histogram', 'Time to send a message or a batch of messages', SECONDS),
+    'kz_messages_sent_total': ('counter', 'Messages sent', None),
+    'kz_commit_seconds': ('histogram', 'Time to commit a transaction of sends', SECONDS),
+    'kz_recv_query_seconds': ('histogram', 'Time of a recv query', SECONDS),
+    'kz_recv_rows': ('histogram', 'Messages returned by a recv query', COUNTS),
+    'kz_idle_polls_total': ('counter', 'recv queries that returned no messages', None),
+    'kz_proxy_rpc_seconds': ('histogram', 'Round trip of a proxy call', SECONDS),
+    'kz_proxy_request_seconds': ('histogram', 'Time the proxy server spent on a request', SECONDS),
+    'kz_wire_bytes_total': ('counter', 'Bytes of encoded proxy requests and replies', None),
+    'kz_handle_seconds': ('histogram', 'Time of handle_message', SECONDS),
+    'kz_agent_messages_total': ('counter', 'Messages received by an agent', None),
+    'kz_agent_traces_total': ('counter', 'Traces an agent received messages from', None),
+    'kz_agent_trace_messages': ('histogram', 'Messages an agent received from a trace, observed once the trace expires', COUNTS),
+    'kz_agent_in_flight': ('gauge', 'Messages received by an agent and not yet handled', None),
+    'kz_memo_hits_total': ('counter', 'Messages answered with memoized replies', None),
+    'kz_memo_misses_total': ('counter', 'Messages of a memoizing agent that had to be handled', None),
+}
+
+enabled = False
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, labels):
+        assert name in METRICS, f"Unknown metric {name}"
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, n, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def set(self, name, value, labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = Histogram(METRICS[name][2])
+
+            h.observe(value)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format"""
+
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda x: x[0])
+            out = []
+            last = None
+            for (name, labels), v in items:
+                kind, help_, buckets = METRICS[name]
+                if name != last:
+                    out.append(f'# HELP {name} {help_}')
+                    out.append(f'# TYPE {name} {kind}')
+                    last = name
+
+                if kind != 'histogram':
+                    out.append(f'{name}{_labels(labels)} {v}')
+                    continue
+
+                cum = 0
+                for le, n in zip(buckets + ['+Inf'], v.counts):
+                    cum += n
+                    out.append(f'{name}_bucket{_labels(labels + (("le", str(le)),))} {cum}')
+                out.append(f'{name}_sum{_labels(labels)} {v.sum}')
+                out.append(f'{name}_count{_labels(labels)} {v.count}')
+
+        return '\n'.join(out) + '\n'
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+REGISTRY = Registry()
+
+# call sites check `metrics.enabled` first where computing the value costs
+# something, these are no-ops when metrics are off
+
+def inc(name, n = 1, **labels):
+    if enabled:
+        REGISTRY.inc(name, n, labels)
+
+def set_gauge(name, value, **labels):
+    if enabled:
+        REGISTRY.set(name, value, labels)
+
+def observe(name, value, **labels):
+    if enabled:
+        REGISTRY.observe(name, value, labels)
+
+def write(path):
+    """Write the metrics of this process to path, atomically"""
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+def _serve(port):
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def enable(directory = None, port = None, name = None, interval = 5):
+    """Turn metrics on. If directory is given, they are written to
+       <directory>/<name>-<pid>.prom every interval seconds and at exit.
+       If port is given, they are served over HTTP on 127.0.0.1:port."""
+
+    global enabled
+    if enabled:
+        return
+
+    enabled = True
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        name = name or os.path.basename(sys.argv[0]) or 'python'
+        path = os.path.join(directory, f'{name}-{os.getpid()}.prom')
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                write(path)
+
+        threading.Thread(target=loop, daemon=True).start()
+        atexit.register(write, path)
+
+    if port is not None:
+        _serve(port)
+
+if os.environ.get('KZ_METRICS_DIR'):
+    enable(os.environ['KZ_METRICS_DIR'])
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def parse(text):
+    """Return {(name, labels): value} and {name: type} of Prometheus text"""
+
+    samples = {}
+    types = {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(None, 3)
+            types[name] = kind
+            continue
+
+        m = _SAMPLE.match(line)
+        if m is None:
+            continue
+
+        labels = tuple(sorted((k, v.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\'))
+                              for k, v in _LABEL.findall(m.group(2) or '')))
+        samples[(m.group(1), labels)] = float(m.group(3))
+
+    return samples, types
+
+def merge(texts):
+    """Sum the samples of several processes"""
+
+    total = {}
+    types = {}
+    for text in texts:
+        samples, t = parse(text)
+        types.update(t)
+        for key, v in samples.items():
+            total[key] = total.get(key, 0) + v
+
+    return total, types
+
+def _quantile(buckets, q):
+    # buckets are (le, cumulative count), the upper bound of the bucket
+    # that holds the quantile is returned
+    count = buckets[-1][1]
+    for le, n in buckets:
+        if n >= q * count:
+            return le
+
+    return buckets[-1][0]
+
+def summarize(total, types):
+    """Return rows of (name, labels, description) for display"""
+
+    rows = []
+    hists = {}
+    for (name, labels), v in sorted(total.items()):
+        base = re.sub(r'_(bucket|sum|count)$', '', name)
+        if types.get(base) == 'histogram':
+            le = dict(labels).get('le')
+            key = (base, tuple(l for l in labels if l[0] != 'le'))
+            h = hists.setdefault(key, {'buckets': [], 'sum': 0, 'count': 0})
+            if name.endswith('_bucket'):
+                h['buckets'].append((float(le), v))
+            elif name.endswith('_sum'):
+                h['sum'] = v
+            else:
+                h['count'] = v
+            continue
+
+        rows.append((name, labels, f'{v:g}'))
+
+    for (name, labels), h in sorted(hists.items()):
+        if h['count'] == 0:
+            continue
+
+        b = sorted(h['buckets'])
+        rows.append((name, labels, f"count={h['count']:g} mean={h['sum'] / h['count']:.3g} p50<={_quantile(b, 0.5):g} p99<={_quantile(b, 0.99):g}"))
+
+    return sorted(rows)
+
+def _read(paths):
+    texts = []
+    for p in paths:
+        if os.path.isdir(p):
+            texts.extend(_read([os.path.join(p, f) for f in sorted(os.listdir(p)) if f.endswith('.prom')]))
+        else:
+            with open(p) as f:
+                texts.append(f.read())
+
+    return texts
+
+def main(argv = None):
+    import argparse
+
+    p = argparse.ArgumentParser(prog='kz stats', description='Show the metrics written by agents started with --kz-metrics')
+    p.add_argument('paths', nargs='+', help='Metrics directories or .prom files')
+    p.add_argument('--prometheus', action='store_true', help='Print the summed metrics in the Prometheus text format')
+    p.add_argument('--watch', type=float, metavar='SECONDS', help='Print again every SECONDS seconds')
+
+    args = p.parse_args(argv)
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"ERROR: {path} does not exist")
+            sys.exit(1)
+
+    try:
+        while True:
+            total, types = merge(_read(args.paths))
+            if args.prometheus:
+                for name, kind in sorted(types.items()):
+                    print(f'# TYPE {name} {kind}')
+                for (name, labels), v in sorted(total.items()):
+                    print(f'{name}{_labels(labels)} {v:g}')
+            else:
+                for name, labels, desc in summarize(total, types):
+                    print(f"{name}{_labels(labels)}  {desc}")
+
+            if args.watch is None:
+                break
+
+            time.sleep(args.watch)
+            print()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import socket
+import select
+import itertools
+
+_counter = itertools.count()
+
+class Notifier:
+    """Wakes up local readers of a database when new messages are written.
+
+       Every waiting reader binds a Unix datagram socket in a sidecar
+       directory next to the database. Writers send a byte to each
+       socket in that directory after they commit. Readers on other
+       hosts are not notified and must fall back to polling.
+    """
+
+    def __init__(self, database):
+        self.path = str(database) + '.kz-notify'
+        self._sock = None
+
+    @staticmethod
+    def supported():
+        return hasattr(socket, 'AF_UNIX')
+
+    def signal(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+
+        if len(names) == 0:
+            return
+
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+
+        for n in names:
+            addr = os.path.join(self.path, n)
+            try:
+                self._sock.sendto(b'!', addr)
+            except BlockingIOError:
+                pass # reader already has wake-ups pending
+            except (ConnectionRefusedError, FileNotFoundError):
+                # reader died without cleaning up
+                try:
+                    os.unlink(addr)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+    def listen(self):
+        """Return a Listener, or None if notifications are unavailable."""
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            return Listener(self.path)
+        except OSError:
+            return None
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+class Listener:
+    def __init__(self, path):
+        self.addr = os.path.join(path, f'{os.getpid()}-{next(_counter)}')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(self.addr)
+        except OSError:
+            self.sock.close()
+            raise
+
+        self.sock.setblocking(False)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a wake-up. Returns True if woken."""
+        return wait_any([self], timeout)
+
+    def drain(self):
+        # coalesce all pending wake-ups
+        try:
+            while True:
+                self.sock.recv(64)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.addr)
+        except OSError:
+            pass
+
+def wait_any(listeners, timeout):
+    """Wait up to timeout seconds for a wake-up on any of the listeners.
+       Returns True if woken."""
+
+    # poll, unlike select, works with descriptors above FD_SETSIZE
+    p = select.poll()
+    for l in listeners:
+        p.register(l.sock, select.POLLIN)
+
+    if not p.poll(timeout * 1000):
+        return False
+
+    for l in listeners:
+        l.drain()
+
+    return True
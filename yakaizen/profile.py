@@ -0,0 +1,264 @@
+"""Timing of a trace, reconstructed from its persisted messages.
+
+   Run as `kz profile-trace <db> <trace_id>`.
+
+   Messages only record when they were sent, so calls of handle_message
+   are inferred: the messages an agent sends with the same sources are
+   the output of one call, which became ready when its last source was
+   sent. Each agent is assumed to handle one message at a time, so a
+   call starts when it is ready or when the agent's previous call ended,
+   whichever is later. The difference is time spent queued.
+"""
+
+import os
+import sys
+import json
+
+from yakaizen.ether_sqlite import SQLiteEther, s2dt
+
+class Job:
+    """An inferred call of handle_message, times are in seconds from the
+       first message of the trace"""
+
+    def __init__(self, sender, msgs, sources):
+        self.sender = sender
+        self.msgs = msgs
+        self.sources = sources
+        self.end = max(m.t for m in msgs)
+        self.ready = self.end
+        self.start = self.end
+        self.pred = None   # the job that gated the start of this one
+
+    @property
+    def queued(self):
+        return self.start - self.ready
+
+    @property
+    def service(self):
+        return self.end - self.start
+
+    @property
+    def label(self):
+        types = sorted(set(m.type_ for m in self.msgs))
+        return ','.join(types)
+
+class TraceProfile:
+    """Jobs, critical path, per-agent times and hop latencies of a trace"""
+
+    def __init__(self, trace, headers, edges):
+        self.trace = trace
+        self.messages = dict((h.message_id, h) for h in headers)
+        self.edges = [(s, d) for s, d in edges if s in self.messages and d in self.messages]
+
+        t0 = min((s2dt(h._sent) for h in headers), default=None)
+        for h in headers:
+            h.t = (s2dt(h._sent) - t0).total_seconds()
+
+        self.jobs = self._jobs()
+        self._schedule()
+        self.critical_path = self._critical_path()
+
+    def _jobs(self):
+        sources = {}
+        for s, d in self.edges:
+            sources.setdefault(d, set()).add(s)
+
+        groups = {}
+        for m in self.messages.values():
+            srcs = frozenset(sources.get(m.message_id, ()))
+            # messages without sources are started by their sender
+            key = (m.sender, srcs) if len(srcs) else (m.sender, None, m.message_id)
+            groups.setdefault(key, []).append(m)
+
+        jobs = [Job(key[0], msgs, key[1] or frozenset()) for key, msgs in groups.items()]
+        self.job_of = {}
+        for j in jobs:
+            for m in j.msgs:
+                self.job_of[m.message_id] = j
+
+        return jobs
+
+    def _schedule(self):
+        for j in self.jobs:
+            if len(j.sources):
+                last = max(j.sources, key=lambda s: self.messages[s].t)
+                j.ready = self.messages[last].t
+                j.pred = self.job_of[last]
+
+        by_sender = {}
+        for j in sorted(self.jobs, key=lambda j: (j.end, j.msgs[0].message_id)):
+            prev = by_sender.get(j.sender)
+            j.start = j.ready
+            if prev is not None and prev.end > j.ready and len(j.sources):
+                j.start = min(prev.end, j.end)
+                j.pred = prev
+
+            by_sender[j.sender] = j
+
+    def _critical_path(self):
+        if len(self.jobs) == 0:
+            return []
+
+        path = [max(self.jobs, key=lambda j: j.end)]
+        while path[-1].pred is not None:
+            path.append(path[-1].pred)
+
+        return path[::-1]
+
+    @property
+    def duration(self):
+        return max((j.end for j in self.jobs), default=0)
+
+    def agents(self):
+        """Return {sender: (jobs, service seconds, queued seconds)}"""
+
+        out = {}
+        for j in self.jobs:
+            n, service, queued = out.get(j.sender, (0, 0, 0))
+            out[j.sender] = (n + 1, service + j.service, queued + j.queued)
+
+        return out
+
+    def hops(self):
+        """Return (src, dst, seconds) for every edge of the trace"""
+
+        return [(self.messages[s], self.messages[d], self.messages[d].t - self.messages[s].t)
+                for s, d in self.edges]
+
+    def _stacks(self, job):
+        # senders from the start of the trace to job, along sources
+        stack = []
+        while job is not None:
+            stack.append(job.sender)
+            srcs = job.sources
+            job = self.job_of[max(srcs, key=lambda s: self.messages[s].t)] if len(srcs) else None
+
+        return stack[::-1]
+
+    def to_folded(self):
+        """Return folded stacks for flamegraph.pl or speedscope, weighted by
+           service time in microseconds"""
+
+        weights = {}
+        for j in self.jobs:
+            key = ';'.join(self._stacks(j) + [j.label])
+            weights[key] = weights.get(key, 0) + int(j.service * 1e6)
+
+        return ''.join(f'{k} {v}\n' for k, v in sorted(weights.items()) if v > 0)
+
+    def to_chrome(self):
+        """Return the trace in the Chrome trace-event format, for
+           chrome://tracing or ui.perfetto.dev"""
+
+        senders = sorted(set(j.sender for j in self.jobs))
+        tid = dict((s, 2 * i + 1) for i, s in enumerate(senders))
+        critical = set(id(j) for j in self.critical_path)
+
+        events = []
+        for s in senders:
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid[s], 'args': {'name': s}})
+            events.append({'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid[s] + 1, 'args': {'name': f'{s} (queued)'}})
+
+        for j in self.jobs:
+            ev = {'name': j.label, 'cat': 'handle', 'ph': 'X', 'pid': 1, 'tid': tid[j.sender],
+                  'ts': j.start * 1e6, 'dur': j.service * 1e6,
+                  'args': {'messages': [m.message_id for m in j.msgs],
+                           'sources': sorted(j.sources), 'queued_us': j.queued * 1e6}}
+            if id(j) in critical:
+                ev['cname'] = 'terrible'
+                ev['args']['critical'] = True
+            events.append(ev)
+
+            if j.queued > 0:
+                events.append({'name': 'queued', 'cat': 'queue', 'ph': 'X', 'pid': 1, 'tid': tid[j.sender] + 1,
+                               'ts': j.ready * 1e6, 'dur': j.queued * 1e6})
+
+        for i, (s, d) in enumerate(self.edges):
+            src, dst = self.job_of[s], self.job_of[d]
+            events.append({'name': 'message', 'cat': 'hop', 'ph': 's', 'id': i, 'pid': 1,
+                           'tid': tid[src.sender], 'ts': self.messages[s].t * 1e6})
+            events.append({'name': 'message', 'cat': 'hop', 'ph': 'f', 'bp': 'e', 'id': i, 'pid': 1,
+                           'tid': tid[dst.sender], 'ts': dst.start * 1e6})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'trace_id': self.trace.trace_id, 'trace_name': self.trace.name}}
+
+    def report(self, hops = 10):
+        """Return a text summary"""
+
+        ms = lambda s: f'{s * 1e3:.3f}ms'
+        out = [f'Trace {self.trace.trace_id} ({self.trace.name}): {len(self.messages)} messages, '
+               f'{len(self.jobs)} handler calls, {ms(self.duration)} from first to last message', '']
+
+        out.append(f'Critical path ({len(self.critical_path)} calls):')
+        out.append(f"  {'at':>12}  {'queued':>12}  {'service':>12}  agent: messages")
+        for j in self.critical_path:
+            out.append(f'  {ms(j.start):>12}  {ms(j.queued):>12}  {ms(j.service):>12}  {j.sender}: {j.label}')
+
+        out.append('')
+        out.append('Agents:')
+        out.append(f"  {'calls':>6}  {'service':>12}  {'mean':>12}  {'queued':>12}  {'mean':>12}  agent")
+        for sender, (n, service, queued) in sorted(self.agents().items(), key=lambda x: -x[1][1]):
+            out.append(f'  {n:>6}  {ms(service):>12}  {ms(service / n):>12}  {ms(queued):>12}  {ms(queued / n):>12}  {sender}')
+
+        slow = sorted(self.hops(), key=lambda h: -h[2])[:hops]
+        if len(slow):
+            out.append('')
+            out.append(f'Slowest hops:')
+            for src, dst, seconds in slow:
+                out.append(f'  {ms(seconds):>12}  {src.sender}:{src.type_} #{src.message_id} -> {dst.sender}:{dst.type_} #{dst.message_id}')
+
+        return '\n'.join(out)
+
+def profile_trace(ether, trace_id):
+    """Return the TraceProfile of a trace in an SQLiteEther, or None if
+       there is no such trace"""
+
+    trace = ether.get_trace(trace_id)
+    if trace is None:
+        return None
+
+    headers, edges = ether.trace_dag(trace)
+    return TraceProfile(trace, headers, edges)
+
+def main(argv = None):
+    import argparse
+
+    p = argparse.ArgumentParser(prog='kz profile-trace', description='Show where the time of a trace went')
+    p.add_argument('database', help='SQLite ether database')
+    p.add_argument('trace_id', type=int, help='Trace to profile')
+    p.add_argument('--format', choices=['text', 'chrome', 'folded'], default='text',
+                   help='chrome writes trace-event JSON for chrome://tracing or ui.perfetto.dev, folded writes stacks for flamegraphs')
+    p.add_argument('-o', '--output', help='Write to this file instead of stdout')
+
+    args = p.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        print(f"ERROR: {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    ether = SQLiteEther(args.database, notify=False, readonly=True)
+    try:
+        prof = profile_trace(ether, args.trace_id)
+    finally:
+        ether.close()
+
+    if prof is None:
+        print(f"ERROR: No trace {args.trace_id} in {args.database}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.format == 'chrome':
+        text = json.dumps(prof.to_chrome())
+    elif args.format == 'folded':
+        text = prof.to_folded()
+    else:
+        text = prof.report() + '\n'
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+if __name__ == "__main__":
+    main()
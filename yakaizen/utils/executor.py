@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# executor.py
+#
+# Run many external commands at once from asyncio.
+#
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import subprocess
+from collections import namedtuple
+
+from yakaizen.utils.runner import MAX_OUTPUT, TIMEOUT_RETURNCODE, CHUNK_SIZE, _signal
+
+logger = logging.getLogger(__name__)
+
+# usage is a dictionary with wall_seconds, user_seconds, system_seconds,
+# max_rss_kb and core, suitable for ResourceConsumption.from_usage.
+# max_rss_kb is never below the size of the forked Python process the
+# command was exec'd from
+JobResult = namedtuple('JOB_RESULT', 'success returncode output errors exception usage')
+
+def available_cores():
+    """Return the cores this process may run on"""
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+async def _wait4(pid):
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return await loop.run_in_executor(None, os.wait4, pid, 0)
+
+    try:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+    finally:
+        os.close(fd)
+
+    return os.wait4(pid, 0)
+
+class Executor:
+    """Runs commands as subprocesses, at most concurrency at a time.
+
+       Concurrency defaults to the number of cores this process may run
+       on. With pin, every job is restricted to the least busy of those
+       cores. Each job reports its wall time and, from wait4, its CPU
+       time and maximum resident set size.
+
+       Use from coroutines, e.g. the handle_message of an AsyncSimpleAgent:
+
+           rr = await executor.run(['make', '-C', path], timeout=600)
+           reply.attach(ResourceConsumption.from_usage(reply, rr.usage))
+    """
+
+    def __init__(self, concurrency = None, pin = False, cores = None, max_output = None, kill_after = 5):
+        self.cores = sorted(cores) if cores is not None else available_cores()
+        self.concurrency = concurrency or len(self.cores)
+        self.pin = pin
+        self.max_output = max_output if max_output is not None else MAX_OUTPUT
+        self.kill_after = kill_after
+
+        assert not pin or hasattr(os, 'sched_setaffinity'), f"Pinning jobs to cores is not supported on {sys.platform}"
+
+        self._jobs_on = dict((c, 0) for c in self.cores)
+        self._sem = None
+
+    def _acquire_core(self):
+        core = min(self.cores, key=lambda c: self._jobs_on[c])
+        self._jobs_on[core] += 1
+        return core
+
+    async def _read(self, pipe, name, kept, on_output):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if len(data) == 0:
+                    break
+
+                if self.max_output == 0:
+                    kept += data
+                elif len(kept) < self.max_output:
+                    kept += data[:self.max_output - len(kept)]
+
+                if on_output is not None:
+                    on_output(name, data)
+        finally:
+            transport.close()
+
+    async def run(self, cmd, timeout = None, on_output = None, **kwargs):
+        """Run cmd once a slot is free, returning a JobResult.
+
+           on_output, timeout and the returncode of a command that timed
+           out are as for yakaizen.utils.runner.stream. Other keyword
+           arguments are passed to subprocess.Popen.
+        """
+        assert type(cmd) is not str
+
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+
+        async with self._sem:
+            core = self._acquire_core() if self.pin else None
+            try:
+                return await self._run([str(s) for s in cmd], timeout, on_output, core, kwargs)
+            finally:
+                if core is not None:
+                    self._jobs_on[core] -= 1
+
+    async def _run(self, cmd, timeout, on_output, core, kwargs):
+        command = " ".join(cmd)
+
+        kwargs.setdefault('stdin', subprocess.DEVNULL)
+        kwargs.setdefault('start_new_session', True)
+        if core is not None:
+            kwargs['preexec_fn'] = lambda: os.sched_setaffinity(0, {core})
+
+        logger.info(f'Running {command}' + (f' on core {core}' if core is not None else ''))
+
+        start = time.monotonic()
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        except Exception as e:
+            logger.error(f'Error when running "{command}"', exc_info = e)
+            return JobResult(success=False, returncode=None, output=None, errors=None, exception=e, usage=None)
+
+        kept = {'stdout': bytearray(), 'stderr': bytearray()}
+        readers = [asyncio.ensure_future(self._read(process.stdout, 'stdout', kept['stdout'], on_output)),
+                   asyncio.ensure_future(self._read(process.stderr, 'stderr', kept['stderr'], on_output))]
+
+        # a process can only be waited for once, so timeouts wait on the
+        # same task, which is left to reap the process if this is cancelled
+        waiter = asyncio.ensure_future(_wait4(process.pid))
+        timed_out = False
+        try:
+            try:
+                _, status, rusage = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f'Stopping "{command}" after {timeout}s')
+                timed_out = True
+                _signal(process, signal.SIGTERM)
+                try:
+                    _, status, rusage = await asyncio.wait_for(asyncio.shield(waiter), self.kill_after)
+                except asyncio.TimeoutError:
+                    _signal(process, signal.SIGKILL)
+                    _, status, rusage = await waiter
+        except BaseException:
+            # cancelled, do not leave the command running
+            _signal(process, signal.SIGKILL)
+            for r in readers:
+                r.cancel()
+            raise
+
+        wall = time.monotonic() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        # children that outlived the command may hold the pipes open
+        done, pending = await asyncio.wait(readers, timeout=self.kill_after if timed_out else None)
+        for r in pending:
+            r.cancel()
+
+        exception = None
+        for r in done:
+            if r.exception() is not None:
+                exception = r.exception()
+
+        returncode = TIMEOUT_RETURNCODE if timed_out else process.returncode
+        if returncode == 0:
+            logger.info(f'Running {command} succeeded')
+        else:
+            logger.error(f'Error when running "{command}", return code={returncode}')
+
+        # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+        max_rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+
+        return JobResult(success=returncode == 0 and exception is None,
+                         returncode=returncode,
+                         output=kept['stdout'].decode('utf-8', errors='replace'),
+                         errors=kept['stderr'].decode('utf-8', errors='replace'),
+                         exception=exception,
+                         usage={'wall_seconds': wall,
+                                'user_seconds': rusage.ru_utime,
+                                'system_seconds': rusage.ru_stime,
+                                'max_rss_kb': max_rss,
+                                'core': core})
+
+    async def map(self, cmds, **kwargs):
+        """Run all of cmds, returning their JobResults in the same order"""
+
+        return await asyncio.gather(*[self.run(cmd, **kwargs) for cmd in cmds])
+
+    def run_all(self, cmds, **kwargs):
+        """map, for callers outside of asyncio such as SimpleAgent"""
+
+        self._sem = None
+        return asyncio.run(self.map(cmds, **kwargs))
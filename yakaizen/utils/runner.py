@@ -11,7 +11,10 @@
 import subprocess
 import logging
 from collections import namedtuple
-import tempfile
+import selectors
+import signal
+import codecs
+import time
 import os
 
 MAX_OUTPUT = 0
@@ -28,83 +31,198 @@ def shorten(output, max_len = MAX_OUTPUT):
 
     return output
 
-def safe_read(f):
-    with open(f, "rb") as h:
-        if MAX_OUTPUT == 0:
-            return h.read()
+# returned as returncode when a command is stopped for running too long,
+# as timeout(1) does
+TIMEOUT_RETURNCODE = 124
+
+CHUNK_SIZE = 65536
+
+def _signal(process, sig):
+    try:
+        if process.pid == os.getpgid(process.pid):
+            os.killpg(process.pid, sig)
         else:
-            return h.read(MAX_OUTPUT)
+            process.send_signal(sig)
+    except ProcessLookupError:
+        pass
 
-def run(cmd, *args, **kwargs):
+def stream(cmd, *args, on_output = None, timeout = None, max_output = None, kill_after = 5, **kwargs):
+    """Run cmd, reading its stdout and stderr as they are written.
+
+       on_output(name, data) is called with every chunk read, name is
+       'stdout' or 'stderr'. Only the first max_output bytes (default
+       MAX_OUTPUT, 0 keeps everything) of each are kept in the result.
+       After timeout seconds, the command and its children are sent
+       SIGTERM, then SIGKILL after kill_after more seconds, and
+       returncode is TIMEOUT_RETURNCODE.
+    """
     assert type(cmd) is not str
 
     cmd = [str(s) for s in cmd]
-
     command = " ".join(cmd)
 
-    hout = None
-    herr = None
+    if max_output is None:
+        max_output = MAX_OUTPUT
 
-    try:
-        if 'stdin' not in kwargs:
-            kwargs['stdin'] = subprocess.DEVNULL
-
-        outfile = None
-        errfile = None
+    if 'stdin' not in kwargs:
+        kwargs['stdin'] = subprocess.DEVNULL
 
-        if 'stdout' not in kwargs:
-            hout, outfile = tempfile.mkstemp()
-            logger.info(f'Logging output to {outfile}')
-            kwargs['stdout'] = hout
+    pipes = [name for name in ('stdout', 'stderr') if name not in kwargs]
+    for name in pipes:
+        kwargs[name] = subprocess.PIPE
 
-        if 'stderr' not in kwargs:
-            herr, errfile = tempfile.mkstemp()
-            logger.info(f'Logging errors to {errfile}')
-            kwargs['stderr'] = herr
+    if timeout is not None and 'start_new_session' not in kwargs:
+        # so that children of cmd can be stopped too
+        kwargs['start_new_session'] = True
 
-        if 'cwd' in kwargs:
-            logging.info(f'Running {command} in {kwargs["cwd"]}')
-        else:
-            logging.info(f'Running {command}')
+    if 'cwd' in kwargs:
+        logger.info(f'Running {command} in {kwargs["cwd"]}')
+    else:
+        logger.info(f'Running {command}')
 
-        process = subprocess.run(cmd, *args, **kwargs)
-        if process.returncode == 0:
-            logging.info(f'Running {command} succeeded')
+    process = None
+    try:
+        process = subprocess.Popen(cmd, *args, **kwargs)
+
+        kept = dict((name, bytearray()) for name in pipes)
+        sel = selectors.DefaultSelector()
+        for name in pipes:
+            sel.register(getattr(process, name), selectors.EVENT_READ, name)
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        timed_out = False
+        while True:
+            if len(sel.get_map()):
+                wait = max(0, deadline - time.monotonic()) if deadline is not None else None
+                for key, _ in sel.select(wait):
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if len(data) == 0:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+
+                    buf = kept[key.data]
+                    if max_output == 0:
+                        buf += data
+                    elif len(buf) < max_output:
+                        buf += data[:max_output - len(buf)]
+
+                    if on_output is not None:
+                        on_output(key.data, data)
+            else:
+                try:
+                    process.wait(max(0, deadline - time.monotonic()) if deadline is not None else None)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+
+            if deadline is not None and time.monotonic() >= deadline:
+                if not timed_out:
+                    logger.error(f'Stopping "{command}" after {timeout}s')
+                    _signal(process, signal.SIGTERM)
+                    timed_out = True
+                    deadline = time.monotonic() + kill_after
+                else:
+                    # children that escaped the process group may hold
+                    # the pipes open, so stop reading
+                    _signal(process, signal.SIGKILL)
+                    break
+
+        sel.close()
+        returncode = process.wait()
+        if timed_out:
+            returncode = TIMEOUT_RETURNCODE
+
+        if returncode == 0:
+            logger.info(f'Running {command} succeeded')
         else:
-            logger.error(f'Error when running "{command}", return code={process.returncode}')
+            logger.error(f'Error when running "{command}", return code={returncode}')
 
-        if hout: output = safe_read(outfile).decode('utf-8')
-        if herr: errors = safe_read(errfile).decode('utf-8')
+        output = kept['stdout'].decode('utf-8', errors='replace') if 'stdout' in kept else None
+        errors = kept['stderr'].decode('utf-8', errors='replace') if 'stderr' in kept else None
 
-        return RunResult(success = process.returncode == 0,
-                         returncode=process.returncode,
+        return RunResult(success = returncode == 0,
+                         returncode=returncode,
                          output=output,
                          processobj=process,
                          errors=errors,
-                         outfile=outfile,
-                         errfile=errfile,
+                         outfile=None,
+                         errfile=None,
                          exception=None)
     except Exception as e:
         logger.error(f'Error when running "{command}"', exc_info = e)
         return RunResult(success = False, returncode=None, output=None, exception=e,
                          processobj=None,errors=None,outfile=None,errfile=None)
     finally:
-        if hout:
-            os.close(hout)
-            os.unlink(outfile)
+        if process is not None:
+            if process.poll() is None:
+                _signal(process, signal.SIGKILL)
+                process.wait()
 
-        if herr:
-            os.close(herr)
-            os.unlink(errfile)
+            for name in pipes:
+                getattr(process, name).close()
 
     assert False
 
+def run(cmd, *args, **kwargs):
+    return stream(cmd, *args, **kwargs)
+
 def run_timeout(timeout_s, cmd, *args, **kwargs):
-    command = ['timeout', f'{timeout_s}s'] + cmd
-    logger.info(f"Running {command}")
-    x = run(command, *args, **kwargs)
-    if x.returncode == 124:
-        #x.output = x.output + "*** TIMEOUT ***\n"
-        pass
+    return stream(cmd, *args, timeout=float(timeout_s), **kwargs)
+
+class OutputForwarder:
+    """An on_output callback for stream that sends the output of a
+       command as messages in reply to msg while it runs.
+
+       Output is sent at most every interval seconds, and when the
+       forwarder is closed:
+
+           with OutputForwarder(self.ether, self.out_channel, self, msg) as fwd:
+               rr = stream(cmd, on_output=fwd)
+    """
+
+    types = {'stdout': 'Partial-Output', 'stderr': 'Partial-Errors'}
+
+    def __init__(self, ether, channel, sender, msg, interval = 1.0, types = None):
+        self.ether = ether
+        self.channel = channel
+        self.sender = sender
+        self.msg = msg
+        self.interval = interval
+        self.types = types or self.types
+
+        self._decoders = dict((name, codecs.getincrementaldecoder('utf-8')(errors='replace')) for name in self.types)
+        self._pending = dict((name, []) for name in self.types)
+        self._last = time.monotonic()
+
+    def __call__(self, name, data):
+        self._pending[name].append(self._decoders[name].decode(data))
+        if time.monotonic() - self._last >= self.interval:
+            self.flush()
+
+    def flush(self, final = False):
+        from yakaizen.core import AsyncMessage
+
+        out = []
+        for name, parts in self._pending.items():
+            if final:
+                parts.append(self._decoders[name].decode(b'', final=True))
+
+            text = ''.join(parts)
+            parts.clear()
+            if len(text):
+                out.append(AsyncMessage(self.channel, self.types[name], self.sender, text, [self.msg], self.msg.trace))
+
+        if len(out):
+            self.ether.send_many(out)
+
+        self._last = time.monotonic()
+
+    def close(self):
+        self.flush(final=True)
+
+    def __enter__(self):
+        return self
 
-    return x
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,297 @@
+"""A compact binary encoding for proxy requests and replies.
+
+   Frames start with a version byte and a frame kind, followed by a
+   single tagged value. Only the fields of messages, traces and
+   attachments are sent, so both ends need not share class definitions
+   beyond those in yakaizen.core. Pickle frames always begin with 0x80,
+   so a server can accept both encodings.
+"""
+
+import struct
+import builtins
+import datetime
+
+from .core import Channel, Trace, AsyncMessage, MessageHeader, Attachment, ATTACHMENT_KINDS
+
+WIRE_VERSION = 1
+
+FRAME_CALL = 0
+FRAME_RET = 1
+FRAME_VALUE = 2
+FRAME_ERROR = 3
+
+_FRAME = struct.Struct('!BB')
+_LEN = struct.Struct('!I')
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_US = datetime.timedelta(microseconds=1)
+
+class WireError(Exception):
+    pass
+
+class RemoteError(Exception):
+    """An exception raised by the other end of a call, whose type is not
+       a builtin exception"""
+
+    def __init__(self, type_name, message):
+        super().__init__(f"{type_name}: {message}")
+        self.type_name = type_name
+
+class SourceRef:
+    """Stands in for a source message, only its id and trace are sent"""
+
+    def __init__(self, message_id, trace):
+        self.message_id = message_id
+        self.trace = trace
+
+def is_wire(frame):
+    return len(frame) >= _FRAME.size and frame[0] == WIRE_VERSION
+
+def _enc_str(out, s):
+    b = s.encode('utf-8')
+    out.append(_LEN.pack(len(b)))
+    out.append(b)
+
+def _enc_seq(out, tag, xs):
+    out.append(tag)
+    out.append(_LEN.pack(len(xs)))
+    for x in xs:
+        _enc(out, x)
+
+def _enc_trace(out, t):
+    out.append(b'X')
+    for x in (t.name, t.trace_id, t.start, t.duration, t.active):
+        _enc(out, x)
+
+def _enc_attachment(out, a):
+    assert a.hash is not None, f"Attachments must be stored before they are sent"
+    out.append(b'A')
+    for x in (a.__class__.__name__, a.type_, a.hash, a.size):
+        _enc(out, x)
+
+def _enc_message(out, m):
+    if isinstance(m, MessageHeader):
+        out.append(b'H')
+        for x in (m.channel, m.type_, m.sender, m.size, m.has_attachments, m.trace, m.message_id):
+            _enc(out, x)
+        return
+
+    out.append(b'M')
+    for x in (m.channel, m.type_, m.sender, m.contents, m.trace, m.message_id):
+        _enc(out, x)
+
+    out.append(_LEN.pack(len(m.sources)))
+    for s in m.sources:
+        _enc(out, s.message_id)
+        _enc(out, s.trace)
+
+    _enc_seq(out, b'l', m.attachments)
+
+def _enc(out, v):
+    if v is None:
+        out.append(b'N')
+    elif v is True:
+        out.append(b'T')
+    elif v is False:
+        out.append(b'F')
+    elif isinstance(v, int):
+        out.append(b'i')
+        out.append(_INT.pack(v))
+    elif isinstance(v, float):
+        out.append(b'd')
+        out.append(_FLOAT.pack(v))
+    elif isinstance(v, str):
+        out.append(b's')
+        _enc_str(out, v)
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        out.append(b'b')
+        out.append(_LEN.pack(len(v)))
+        out.append(bytes(v))
+    elif isinstance(v, list):
+        _enc_seq(out, b'l', v)
+    elif isinstance(v, tuple):
+        _enc_seq(out, b't', v)
+    elif isinstance(v, (set, frozenset)):
+        _enc_seq(out, b'e', list(v))
+    elif isinstance(v, dict):
+        out.append(b'm')
+        out.append(_LEN.pack(len(v)))
+        for k, x in v.items():
+            _enc(out, k)
+            _enc(out, x)
+    elif isinstance(v, datetime.datetime):
+        out.append(b'D')
+        out.append(_INT.pack((v - EPOCH) // ONE_US))
+    elif isinstance(v, datetime.timedelta):
+        out.append(b'R')
+        out.append(_INT.pack(v // ONE_US))
+    elif isinstance(v, Channel):
+        out.append(b'C')
+        _enc_str(out, v.name)
+    elif isinstance(v, Trace):
+        _enc_trace(out, v)
+    elif isinstance(v, AsyncMessage):
+        _enc_message(out, v)
+    elif isinstance(v, Attachment):
+        _enc_attachment(out, v)
+    else:
+        raise WireError(f"Cannot encode {type(v)}")
+
+class _Decoder:
+    def __init__(self, frame):
+        self.buf = memoryview(frame)
+        self.pos = 0
+
+    def _unpack(self, st):
+        v = st.unpack_from(self.buf, self.pos)
+        self.pos += st.size
+        return v[0]
+
+    def _raw(self, n):
+        if self.pos + n > len(self.buf):
+            raise WireError("Truncated frame")
+
+        b = self.buf[self.pos:self.pos+n]
+        self.pos += n
+        return b
+
+    def _str(self):
+        return str(self._raw(self._unpack(_LEN)), 'utf-8')
+
+    def _items(self):
+        return [self.value() for _ in range(self._unpack(_LEN))]
+
+    def _trace(self):
+        name, trace_id, start, duration, active = (self.value() for _ in range(5))
+        return Trace(name, trace_id, start, duration, active)
+
+    def _message(self):
+        channel, type_, sender, contents, trace, message_id = (self.value() for _ in range(6))
+        sources = []
+        for _ in range(self._unpack(_LEN)):
+            src_id = self.value()
+            sources.append(SourceRef(src_id, self.value()))
+
+        msg = AsyncMessage(channel, type_, sender, contents, sources, trace)
+        msg.message_id = message_id
+
+        for att in self.value():
+            att.message = msg
+            msg.attach(att)
+
+        return msg
+
+    def _header(self):
+        channel, type_, sender, size, has_attachments, trace, message_id = (self.value() for _ in range(7))
+        msg = MessageHeader(None, channel, type_, sender, size, has_attachments, trace)
+        msg.message_id = message_id
+        return msg
+
+    def _attachment(self):
+        kind, type_, h, size = (self.value() for _ in range(4))
+        att = ATTACHMENT_KINDS.get(kind, Attachment)(None, type_, None)
+        att.hash = h
+        att.size = size
+        return att
+
+    def value(self):
+        tag = bytes(self._raw(1))
+        if tag == b'N':
+            return None
+        elif tag == b'T':
+            return True
+        elif tag == b'F':
+            return False
+        elif tag == b'i':
+            return self._unpack(_INT)
+        elif tag == b'd':
+            return self._unpack(_FLOAT)
+        elif tag == b's':
+            return self._str()
+        elif tag == b'b':
+            return bytes(self._raw(self._unpack(_LEN)))
+        elif tag == b'l':
+            return self._items()
+        elif tag == b't':
+            return tuple(self._items())
+        elif tag == b'e':
+            return set(self._items())
+        elif tag == b'm':
+            n = self._unpack(_LEN)
+            out = {}
+            for _ in range(n):
+                k = self.value()
+                out[k] = self.value()
+            return out
+        elif tag == b'D':
+            return EPOCH + datetime.timedelta(microseconds=self._unpack(_INT))
+        elif tag == b'R':
+            return datetime.timedelta(microseconds=self._unpack(_INT))
+        elif tag == b'C':
+            return Channel(self._str())
+        elif tag == b'X':
+            return self._trace()
+        elif tag == b'M':
+            return self._message()
+        elif tag == b'H':
+            return self._header()
+        elif tag == b'A':
+            return self._attachment()
+        else:
+            raise WireError(f"Unknown tag {tag}")
+
+def _frame(kind, value):
+    out = [_FRAME.pack(WIRE_VERSION, kind)]
+    _enc(out, value)
+    return b''.join(out)
+
+def _unframe(frame, kind):
+    if not is_wire(frame):
+        raise WireError("Not a wire frame or unsupported version")
+
+    if frame[1] != kind:
+        raise WireError(f"Expected frame kind {kind}, got {frame[1]}")
+
+    d = _Decoder(frame)
+    d.pos = _FRAME.size
+    try:
+        return d.value()
+    except struct.error as e:
+        raise WireError("Truncated frame") from e
+
+def encode_call(cmd, *args, **kwargs):
+    return _frame(FRAME_CALL, (cmd, args, kwargs))
+
+def decode_call(frame):
+    """Return (cmd, args, kwargs)"""
+    cmd, args, kwargs = _unframe(frame, FRAME_CALL)
+    return (cmd, args, kwargs)
+
+def encode_ret(value):
+    return _frame(FRAME_RET, value)
+
+def encode_error(exc):
+    """Encode an exception raised by a call, in place of its return value"""
+    message = str(exc.args[0]) if len(exc.args) == 1 else str(exc)
+    return _frame(FRAME_ERROR, (type(exc).__name__, message))
+
+def decode_ret(frame):
+    """Return the value of a call, or raise the exception it failed with"""
+    if is_wire(frame) and frame[1] == FRAME_ERROR:
+        type_name, message = _unframe(frame, FRAME_ERROR)
+        cls = getattr(builtins, type_name, None)
+        if isinstance(cls, type) and issubclass(cls, Exception):
+            raise cls(message)
+
+        raise RemoteError(type_name, message)
+
+    return _unframe(frame, FRAME_RET)
+
+def encode_value(value):
+    """Encode a value outside of a call, e.g. for a ring buffer record"""
+    return _frame(FRAME_VALUE, value)
+
+def decode_value(frame):
+    return _unframe(frame, FRAME_VALUE)